@@ -0,0 +1,61 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+"""Time importing a module in fresh interpreters
+
+For example:
+
+    python3 benchmarks/import_time.py dzz_ui.dzz_ui --runs 10
+
+Each run starts a new interpreter so module caches do not hide
+import costs such as connecting to the db or service discovery.
+Compare the numbers before and after a change.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+TIMER = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+
+def time_import(module, runs):
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-c", TIMER.format(module=module)],
+            env=dict(os.environ, KIVY_NO_ARGS="1", KIVY_NO_CONSOLELOG="1"),
+        )
+        times.append(float(output.decode().strip().splitlines()[-1]))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("module", nargs="?", default="dzz_ui.dzz_ui")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    times = time_import(args.module, args.runs)
+    print(
+        "{} runs of import {}: min {:.3f}s median {:.3f}s max {:.3f}s".format(
+            args.runs,
+            args.module,
+            min(times),
+            statistics.median(times),
+            max(times),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import time
+
+import dzz_ui.crop as crop
+import dzz_ui.db as db
+from dzz_ui.db import redis_conn
+from dzz_ui.models import (
+    NamedList,
+    apply_session_op,
+    generate_scripts,
+    regionpages_from_xml,
+)
+from dzz_ui.ocr_cache import OcrCache
+from dzz_ui.runner import SourceRunner
+from dzz_ui.startup import lazy_import
+
+etree = lazy_import("lxml.etree")
+
+SESSION_KEY_TEMPLATE = "dzz:session:{host}:{port}"
+SOURCES_KEY_TEMPLATE = "machinic:structured:{host}:{port}"
+ERRORS_KEY_TEMPLATE = "dzz:run_errors:{host}:{port}"
+OCR_CACHE_KEY_TEMPLATE = "dzz:ocr_cache:{host}:{port}"
+
+
+def load_session(session_key, session_sync="xml"):
+    """Regionpages of the stored session, without widgets
+
+    With oplog sync the ops added to the stream after the last
+    compaction are applied on top of the stored document.
+    """
+    xml, stream_id = redis_conn.hmget(session_key, "xml", "stream_id")
+    if xml is None:
+        region_pages = NamedList()
+    else:
+        region_pages = regionpages_from_xml(etree.fromstring(xml))
+    if session_sync == "oplog":
+        for op_id, op in redis_conn.xrange(session_key + ":ops", min=stream_id or "-"):
+            # the range is inclusive of the compacted op
+            if op_id != stream_id:
+                apply_session_op(region_pages, op)
+    return region_pages
+
+
+def run_batch(args):
+    db.configure(host=args.db_host, port=args.db_port, db=args.db)
+    db_host = redis_conn.connection_pool.connection_kwargs["host"]
+    db_port = redis_conn.connection_pool.connection_kwargs["port"]
+
+    region_pages = load_session(
+        SESSION_KEY_TEMPLATE.format(host=db_host, port=db_port), args.session_sync
+    )
+    if not region_pages:
+        print("no session stored for {}:{}".format(db_host, db_port))
+        return 1
+    if args.regionpage is not None:
+        if region_pages.get(args.regionpage) is None:
+            print("no regionpage named {}".format(args.regionpage))
+            return 1
+        region_pages = [region_pages.get(args.regionpage)]
+    region_scripts, rule_scripts = generate_scripts(region_pages)
+    # scripts of the keli crop engine, the inprocess one replaces them
+    scripts = []
+    crops = None
+    ocr_cache = None
+    if args.crop_engine == "inprocess":
+        crops = crop.crop_plan(region_pages)
+        if args.ocr_cache_size:
+            ocr_cache = OcrCache(
+                OCR_CACHE_KEY_TEMPLATE.format(host=db_host, port=db_port),
+                max_entries=args.ocr_cache_size,
+                settings=args.ocr_settings,
+            )
+    else:
+        scripts.append(region_scripts)
+    scripts.append(rule_scripts)
+    if args.dry_run:
+        for name, coordinates in crops or []:
+            print("crop {} to {}_key".format(coordinates, name))
+        for script in scripts:
+            print(script)
+        return 0
+
+    def env_vars(key, position):
+        return {
+            "$DB_PORT": db_port,
+            "$DB_HOST": db_host,
+            "$KEY": args.db_key_field,
+            "$SEQUENCE": position,
+        }
+
+    runner = SourceRunner(
+        scripts,
+        SOURCES_KEY_TEMPLATE.format(host=db_host, port=db_port),
+        env_vars,
+        workers=args.workers,
+        pool=args.pool,
+        batch_size=args.batch_size,
+        errors_key=ERRORS_KEY_TEMPLATE.format(host=db_host, port=db_port),
+        crops=crops,
+        key_field=args.db_key_field,
+        ocr_cache=ocr_cache,
+    )
+    runner.start()
+    try:
+        while runner.running:
+            time.sleep(args.progress_interval)
+            print_progress(runner.progress())
+    except KeyboardInterrupt:
+        runner.cancel()
+        while runner.running:
+            time.sleep(0.1)
+    progress = runner.progress()
+    print_progress(progress)
+    elapsed = runner.finished - runner.started
+    print("finished in {:.1f}s".format(elapsed))
+    if ocr_cache is not None:
+        stats = ocr_cache.stats()
+        print(
+            "ocr cache {} entries {} hits {} misses {:.0%} hit rate".format(
+                stats["entries"], stats["hits"], stats["misses"], stats["hit_rate"]
+            )
+        )
+    if progress["error"] is not None or progress["failed"] or progress["cancelled"]:
+        return 1
+    return 0
+
+
+def print_progress(progress):
+    eta = "-"
+    if progress["eta"] is not None:
+        eta = "{:.0f}s".format(progress["eta"])
+    state = ""
+    if progress["cancelled"]:
+        state = " cancelled"
+    print(
+        "{}/{} done {} failed {:.1f}/s eta {}{}".format(
+            progress["done"],
+            progress["total"],
+            progress["failed"],
+            progress["rate"],
+            eta,
+            state,
+        )
+    )
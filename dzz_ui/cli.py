@@ -0,0 +1,221 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import argparse
+import os
+import sys
+
+from dzz_ui.startup import profile
+
+
+def add_db_arguments(parser):
+    parser.add_argument("--db-host", help="db host ip, requires use of --db-port")
+    parser.add_argument(
+        "--db-port", type=int, help="db port, requires use of --db-host"
+    )
+    parser.add_argument("--db", type=int, default=0, help="db index")
+
+
+def add_run_arguments(parser):
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="source hashes fetched per round trip when running on all",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of sources processed at once when running on all",
+    )
+    parser.add_argument(
+        "--pool",
+        choices=["thread", "process"],
+        default="thread",
+        help="worker pool used when running on all",
+    )
+    parser.add_argument(
+        "--crop-engine",
+        choices=["inprocess", "keli"],
+        default="inprocess",
+        help="crop all regions from one decode or run keli per region",
+    )
+    parser.add_argument(
+        "--ocr-cache-size",
+        type=int,
+        default=100000,
+        help="ocr results kept for reuse by the inprocess crop engine, 0 disables",
+    )
+    parser.add_argument(
+        "--ocr-settings",
+        default="",
+        help="ocr settings, cached results are only reused for the same settings",
+    )
+
+
+def add_session_sync_argument(parser):
+    parser.add_argument(
+        "--session-sync",
+        choices=["xml", "oplog"],
+        default="xml",
+        help="sync sessions as a full document or as a stream of changes",
+    )
+
+
+def ui_parser():
+    parser = argparse.ArgumentParser(
+        prog="dzz-ui",
+        epilog="kivy options go before --, for example: "
+        "dzz-ui --size=1500x800 -- --db-key KEY --db-key-field binary_key",
+    )
+    parser.add_argument("--db-key", help="db hash key")
+    parser.add_argument("--db-key-field", help="db hash field")
+
+    add_db_arguments(parser)
+    parser.add_argument(
+        "--listener",
+        choices=["blocking", "polling"],
+        default="blocking",
+        help="block on the pubsub socket or poll it every millisecond",
+    )
+    parser.add_argument(
+        "--event-window",
+        type=float,
+        default=0.1,
+        help="seconds to collect db events before applying them",
+    )
+    parser.add_argument(
+        "--virtualize-fields",
+        type=int,
+        default=200,
+        help="show fields in a recycling list when a hash has more fields than this",
+    )
+    add_run_arguments(parser)
+    parser.add_argument(
+        "--write-mode",
+        choices=["atomic", "optimistic"],
+        default="atomic",
+        help="optimistic refuses to write fields changed by others since last read",
+    )
+    add_session_sync_argument(parser)
+    parser.add_argument(
+        "--session-compact",
+        type=int,
+        default=200,
+        help="stream length at which session changes are compacted",
+    )
+    parser.add_argument(
+        "--session-flush",
+        type=float,
+        default=0.5,
+        help="seconds without session changes before they are written",
+    )
+    parser.add_argument(
+        "--session-max-staleness",
+        type=float,
+        default=2.0,
+        help="longest time in seconds a session change waits to be written",
+    )
+    parser.add_argument(
+        "--texture-cache-mb",
+        type=int,
+        default=768,
+        help="memory budget in megabytes for decoded image cache, should hold "
+        "2 * prefetch + 1 decoded images",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="number of sources ahead and behind to prefetch when browsing",
+    )
+    parser.add_argument(
+        "--sync-image-load",
+        action="store_true",
+        help="decode reloaded images on the ui thread",
+    )
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="print import, first db round trip, first decode and first frame times",
+    )
+    return parser
+
+
+def batch_parser():
+    parser = argparse.ArgumentParser(
+        prog="dzz-ui batch",
+        description="apply the stored session to every source without a display",
+    )
+    add_db_arguments(parser)
+    parser.add_argument(
+        "--db-key-field",
+        default="binary_key",
+        help="source hash field holding the image key",
+    )
+    add_run_arguments(parser)
+    add_session_sync_argument(parser)
+    parser.add_argument("--regionpage", help="only run this regionpage")
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        default=2.0,
+        help="seconds between progress lines",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="print generated scripts and exit"
+    )
+    return parser
+
+
+def batch_main(argv):
+    parser = batch_parser()
+    args = parser.parse_args(argv)
+    if bool(args.db_host) != bool(args.db_port):
+        parser.error("--db-host and --db-port values are both required")
+
+    from dzz_ui import batch
+
+    sys.exit(batch.run_batch(args))
+
+
+def split_argv(argv):
+    """Split arguments into kivy arguments and app arguments"""
+    if "--" in argv:
+        position = argv.index("--")
+        return argv[:position], argv[position + 1 :]
+    return [], argv
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["batch"]:
+        return batch_main(argv[1:])
+    kivy_args, app_args = split_argv(argv)
+
+    # parse before importing the ui, so that --help and
+    # argument errors do not wait on kivy and the rest
+    parser = ui_parser()
+    args = parser.parse_args(app_args)
+    if bool(args.db_host) != bool(args.db_port):
+        parser.error("--db-host and --db-port values are both required")
+
+    if args.startup_profile:
+        profile.enabled = True
+    if not kivy_args:
+        # otherwise kivy tries to parse app arguments
+        os.environ.setdefault("KIVY_NO_ARGS", "1")
+
+    with profile.timed("import dzz_ui.dzz_ui"):
+        from dzz_ui import dzz_ui
+
+    dzz_ui.run(args)
+
+
+if __name__ == "__main__":
+    main()
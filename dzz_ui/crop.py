@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import hashlib
+import io
+
+from dzz_ui.db import redis_conn, binary_r
+from dzz_ui.startup import lazy_import
+
+PImage = lazy_import("PIL.Image")
+
+
+def crop_plan(region_pages):
+    """Output name and scaled coordinates of every region
+
+    Returns a list of (name, (x, y, w, h)) in region order so
+    that later regions writing the same field win, as they do
+    when crops run as scripts. Only plain tuples, can be sent to
+    worker processes.
+    """
+    plan = []
+    for region_page in region_pages:
+        for region in region_page.regions:
+            plan.append(
+                (region_page.output_name(region), tuple(region.coordinates_scaled))
+            )
+    return plan
+
+
+def crop_key(image_key, coordinates):
+    """Key of a crop, the same crop of the same image is
+    always written to the same key"""
+    return "{}:crop:{}:{}:{}:{}".format(image_key, *coordinates)
+
+
+def crop_box(coordinates, size):
+    # clamp to the image, pil pads crops outside with black
+    x, y, w, h = coordinates
+    width, height = size
+    x1 = min(max(0, x), width)
+    y1 = min(max(0, y), height)
+    return (x1, y1, min(max(x1, x + w), width), min(max(y1, y + h), height))
+
+
+def crop_regions(key, image_key, plan):
+    """Crop every region of plan from the image stored at image_key
+
+    The image is fetched and decoded once. Crops are stored at
+    crop_key() and their keys set as {name}_key fields of the
+    source hash key, all in one pipelined round trip. Returns
+    a content hash of the image and the fields set.
+    """
+    if not plan or image_key is None:
+        return None, {}
+    contents = binary_r.get(image_key)
+    if contents is None:
+        raise KeyError("no image stored at {}".format(image_key))
+    fingerprint = hashlib.sha1(contents).hexdigest()
+    img = PImage.open(io.BytesIO(contents))
+    image_format = img.format or "PNG"
+    img.load()
+
+    crops = collections.OrderedDict()
+    fields = collections.OrderedDict()
+    for name, coordinates in plan:
+        box = crop_box(coordinates, img.size)
+        if box[0] == box[2] or box[1] == box[3]:
+            # nothing to crop
+            continue
+        if coordinates not in crops:
+            crop = img.crop(box)
+            encoded = io.BytesIO()
+            crop.save(encoded, image_format)
+            crop.close()
+            crops[coordinates] = encoded.getvalue()
+        fields["{}_key".format(name)] = crop_key(image_key, coordinates)
+    img.close()
+
+    pipe = redis_conn.pipeline(transaction=False)
+    for coordinates, contents in crops.items():
+        pipe.set(crop_key(image_key, coordinates), contents)
+    if fields:
+        pipe.hmset(key, fields)
+    pipe.execute()
+    return fingerprint, fields
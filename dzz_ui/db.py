@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import json
+import os
+import time
+
+from dzz_ui.startup import lazy_import
+
+redis = lazy_import("redis")
+
+DISCOVERY_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "dzz_ui", "service_connection.json"
+)
+
+
+class Connections(object):
+    """Single connection pool shared by a text and a binary client
+
+    Nothing is created until first use. If host and port are not
+    configured they are found with service discovery, results of
+    discovery are cached on disk for discovery_ttl seconds so that
+    relaunching does not wait on it again.
+    """
+
+    def __init__(self, discovery_ttl=60):
+        self.host = None
+        self.port = None
+        self.db = 0
+        self.discovery_ttl = discovery_ttl
+        self.pool = None
+        self.text = None
+        self.binary = None
+
+    def configure(self, host=None, port=None, db=0):
+        self.host = host
+        self.port = port
+        self.db = db
+        if self.pool is not None:
+            self.pool.disconnect()
+        self.pool = None
+        self.text = None
+        self.binary = None
+
+    def get_pool(self):
+        if self.pool is None:
+            host, port = self.host, self.port
+            if not (host and port):
+                host, port = discover(self.discovery_ttl)
+            self.pool = redis.ConnectionPool(
+                host=host, port=port, db=self.db, decode_responses=True
+            )
+        return self.pool
+
+    def settings(self):
+        """(host, port, db) in use, after discovery if needed"""
+        kwargs = self.get_pool().connection_kwargs
+        return kwargs["host"], kwargs["port"], kwargs["db"]
+
+    def text_client(self):
+        if self.text is None:
+            self.text = redis.StrictRedis(connection_pool=self.get_pool())
+        return self.text
+
+    def binary_client(self):
+        if self.binary is None:
+            self.binary = BinaryView(self.text_client())
+        return self.binary
+
+
+class BinaryView(object):
+    """Commands that return raw bytes, run through a text client
+
+    Uses the connections of the text client, so images and text
+    share one pool. Wraps a pipeline the same way, pipelines must
+    not be transactions since EXEC replies are always decoded.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def raw():
+        # option understood by redis-py parse_response to return
+        # a reply undecoded, looked up so a rename fails loudly
+        return {redis.client.NEVER_DECODE: []}
+
+    def get(self, name):
+        return self.client.execute_command("GET", name, **self.raw())
+
+    def getrange(self, key, start, end):
+        return self.client.execute_command("GETRANGE", key, start, end, **self.raw())
+
+    def strlen(self, name):
+        return self.client.strlen(name)
+
+    def set(self, name, value, **kwargs):
+        return self.client.set(name, value, **kwargs)
+
+    def pipeline(self, transaction=False):
+        if transaction:
+            raise ValueError("binary replies are not available in transactions")
+        return BinaryView(self.client.pipeline(transaction=False))
+
+    def execute(self):
+        return self.client.execute()
+
+    @property
+    def connection_pool(self):
+        return self.client.connection_pool
+
+
+class LazyClient(object):
+    """Stand-in for a client that is created on first attribute access"""
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)
+
+
+def discover(ttl=60, cache_path=DISCOVERY_CACHE):
+    """Return (host, port) of the db, cached for ttl seconds"""
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if time.time() - cached["time"] < ttl:
+            return cached["host"], cached["port"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    from ma_cli import data_models
+
+    host, port = data_models.service_connection()
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump({"host": host, "port": port, "time": time.time()}, f)
+    except OSError:
+        pass
+    return host, port
+
+
+connections = Connections()
+configure = connections.configure
+redis_conn = LazyClient(connections.text_client)
+binary_r = LazyClient(connections.binary_client)
@@ -4,17 +4,18 @@
 #
 # Copyright (c) 2018, Galen Curwen-McAdams
 
-import argparse
 import atexit
+import collections
+import concurrent.futures
+import functools
 import io
-import textwrap
+import itertools
+import os
+import threading
+import time
 import uuid
 import operator
-import redis
-from PIL import Image as PImage
 import attr
-import colour
-from lxml import etree
 
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
@@ -27,171 +28,513 @@ from kivy.uix.checkbox import CheckBox
 from kivy.uix.dropdown import DropDown
 from kivy.animation import Animation
 from kivy.graphics import Color, Line, Ellipse, InstructionGroup
+from kivy.graphics.texture import Texture
 from kivy.graphics.vertex_instructions import VectorRectangle, VectorEllipse
 from kivy.uix.label import Label
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
 from kivy.properties import BooleanProperty
 
-from ma_cli import data_models
-from lings import ruling, pipeling
-import fold_ui.keyling as keyling
+import dzz_ui.crop as crop
+import dzz_ui.db as db
+from dzz_ui.db import redis_conn, binary_r
+from dzz_ui.jobs import JobQueue
+from dzz_ui.models import (
+    NamedList,
+    Region,
+    RegionPage,
+    RuleSet,
+    RuleWidget,
+    RULE_TYPES,
+    apply_region_op,
+    crop_script,
+    generate_scripts,
+    ocr_script,
+    update_regions_from_xml,
+)
+from dzz_ui.ocr_cache import OcrCache
+from dzz_ui.planner import StepPlanner
+from dzz_ui.runner import (
+    SourceRunner,
+    compile_script,
+    fetch_source,
+    run_keyling,
+    run_regions,
+)
+from dzz_ui.startup import lazy_import, profile
+
+# imported on first use to keep startup fast
+redis = lazy_import("redis")
+PImage = lazy_import("PIL.Image")
+colour = lazy_import("colour")
+etree = lazy_import("lxml.etree")
+ruling = lazy_import("lings.ruling")
+pipeling = lazy_import("lings.pipeling")
+keyling = lazy_import("fold_ui.keyling")
+
+
+# keyevents of commands that change or remove a string value,
+# cached textures of the key are stale after any of them
+IMAGE_EVENTS = (
+    "set",
+    "setrange",
+    "append",
+    "del",
+    "expired",
+    "evicted",
+    "rename_from",
+    "rename_to",
+)
+
+
+class TextureCache(object):
+    """Least recently used cache of decoded image textures
+
+    Entries are keyed by image key and stay valid until the key
+    is invalidated, the app does that on the db keyevents in
+    IMAGE_EVENTS, so a reload of an unchanged image skips both
+    the fetch and the decode without reading the image. Loads
+    take a version() before fetching, a put of a load that was
+    invalidated in the meantime is dropped. Size is bounded by
+    an approximate byte budget of the decoded pixels rather
+    than entry count.
+    """
+
+    def __init__(self, max_bytes=768 * 1024 * 1024, remembered=1000):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # version at which recently invalidated keys were
+        # invalidated, older ones are forgotten
+        self.version_counter = 0
+        self.invalidated = collections.OrderedDict()
+        self.remembered = remembered
+        self.forgotten = 0
+        # accessed from image loader and pubsub threads
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def texture_bytes(texture):
+        return texture.width * texture.height * len(texture.colorfmt)
+
+    def version(self):
+        with self.lock:
+            return self.version_counter
+
+    def get(self, key):
+        with self.lock:
+            try:
+                texture, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # reinsert as most recently used
+            self.entries[key] = (texture, size)
+            self.hits += 1
+            return texture
+
+    def put(self, key, texture, version):
+        size = self.texture_bytes(texture)
+        with self.lock:
+            if version < max(self.invalidated.get(key, 0), self.forgotten):
+                # changed while it was loaded
+                return
+            self.drop(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (texture, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self.entries:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def drop(self, key):
+        with self.lock:
+            if key in self.entries:
+                _, size = self.entries.pop(key)
+                self.current_bytes -= size
+
+    def invalidate(self, key):
+        with self.lock:
+            self.drop(key)
+            self.version_counter += 1
+            self.invalidated.pop(key, None)
+            self.invalidated[key] = self.version_counter
+            while len(self.invalidated) > self.remembered:
+                _, self.forgotten = self.invalidated.popitem(last=False)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
 
-r_ip, r_port = data_models.service_connection()
-binary_r = redis.StrictRedis(host=r_ip, port=r_port)
-redis_conn = redis.StrictRedis(host=r_ip, port=r_port, decode_responses=True)
 
+texture_cache = TextureCache()
 
-@attr.s
-class RegionPage(object):
-    name = attr.ib()
-    regions = attr.ib(default=attr.Factory(list))
-    color = attr.ib(default=None)
-    rules_widget = attr.ib(default=None)
 
-    @property
-    def scripts(self):
-        scripts = "("
-        for region in self.regions:
-            # suffixes _key and _ocr
-            scripts += textwrap.dedent(
-                """$$(<"keli img-crop-to-key [*] $KEY --x1 {} --y1 {} --width {} --height {} --to-key {region}_key --db-port $DB_PORT --db-host $DB_HOST">),
-                      $$(<"keli img-ocr-fan-in [*] {region}_key --to-key {region}_ocr --db-port $DB_PORT --db-host $DB_HOST">),""".format(
-                    *region.coordinates_scaled, region=self.name
+class ImageLoader(object):
+    """Fetch and decode images on worker threads
+
+    Only the texture upload is done on the main thread. Each load
+    is tagged with a generation for its target, a newer load for
+    the same target makes older ones stale and they are dropped
+    at the next checkpoint instead of being displayed.
+    """
+
+    def __init__(self, workers=2):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.generations = {}
+        self.generation_counter = 0
+        self.lock = threading.Lock()
+        self.cancelled = 0
+
+    def load(self, target, image_key, callback, key=None, key_field=None):
+        """Load image_key, or the key stored in key_field of hash key
+        if image_key is None, and call callback with the texture on the
+        main thread"""
+        with self.lock:
+            self.generation_counter += 1
+            generation = self.generation_counter
+            self.generations[target] = generation
+        self.executor.submit(
+            self._load, target, generation, image_key, callback, key, key_field
+        )
+
+    def is_current(self, target, generation):
+        with self.lock:
+            current = self.generations.get(target) == generation
+            if not current:
+                self.cancelled += 1
+            return current
+
+    def finish(self, target, generation):
+        with self.lock:
+            if self.generations.get(target) == generation:
+                self.generations.pop(target)
+
+    def _load(self, target, generation, image_key, callback, key, key_field):
+        try:
+            version = texture_cache.version()
+            if image_key is None:
+                image_key = redis_conn.hget(key, key_field)
+            if not self.is_current(target, generation):
+                return
+            texture = texture_cache.get(image_key)
+            if texture is not None:
+                Clock.schedule_once(
+                    lambda dt: self._deliver(target, generation, texture, callback)
+                )
+                return
+            contents = load_image(image_key)
+            if not self.is_current(target, generation):
+                return
+            with profile.timed("first image decode", once=True):
+                size, colorfmt, pixels = decode_pixels(contents)
+            if not self.is_current(target, generation):
+                return
+            Clock.schedule_once(
+                lambda dt: self._upload(
+                    target,
+                    generation,
+                    image_key,
+                    version,
+                    size,
+                    colorfmt,
+                    pixels,
+                    callback,
                 )
             )
-        scripts += ")"
-        return scripts
+        except Exception as ex:
+            print(ex)
 
-    @color.validator
-    def check(self, attribute, value):
-        if value is None:
-            setattr(self, "color", colour.Color(pick_for=self))
+    def _deliver(self, target, generation, texture, callback):
+        if self.is_current(target, generation):
+            self.finish(target, generation)
+            callback(texture)
+
+    def _upload(
+        self,
+        target,
+        generation,
+        image_key,
+        version,
+        size,
+        colorfmt,
+        pixels,
+        callback,
+    ):
+        if not self.is_current(target, generation):
+            return
+        self.finish(target, generation)
+        texture = pixels_to_texture(size, colorfmt, pixels)
+        texture_cache.put(image_key, texture, version)
+        callback(texture)
 
-    def as_xml(self):
-        regionpage = etree.Element("regionpage")
-        regionpage.set("color", self.color.hex_l)
-        regionpage.set("name", self.name)
-        for region in self.regions:
-            regionpage.append(region.as_xml())
-        for rule in self.rules_widget.as_xml():
-            regionpage.append(rule)
-        return regionpage
 
+image_loader = ImageLoader()
 
-@attr.s
-class Rule(object):
-    source = attr.ib()
-    symbol = attr.ib()
-    values = attr.ib()
-    destination = attr.ib()
-    result = attr.ib()
 
+class EventCoalescer(object):
+    """Batch bursts of db events per channel
 
-@attr.s
-class RuleWidget(object):
-    source_widget = attr.ib()
-    symbol_widget = attr.ib()
-    values_widget = attr.ib()
-    destination_widget = attr.ib()
-    result_widget = attr.ib()
-    enabled_widget = attr.ib()
+    Events added within window seconds of the first pending event
+    are collapsed per channel. When the window closes handler is
+    called once on the main thread with an ordered dict of channel
+    to the list of its events.
+    """
 
-    @property
-    def enabled(self):
-        if self.enabled_widget.pressed:
-            return True
-        else:
-            return False
+    def __init__(self, handler, window=0.1):
+        self.handler = handler
+        self.window = window
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.received = 0
+        self.delivered = 0
+        self.flush_scheduled = False
 
     @property
-    def rule(self):
-        return Rule(
-            source=self.source_widget.text,
-            symbol=self.symbol_widget.text,
-            values=self.values_widget.text,
-            destination=self.destination_widget.text,
-            result=self.result_widget.text,
-        )
+    def collapsed(self):
+        return self.received - self.delivered - len(self.pending)
+
+    def add(self, channel, event=None):
+        with self.lock:
+            self.received += 1
+            self.pending.setdefault(channel, []).append(event)
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        Clock.schedule_once(lambda dt: self.flush(), self.window)
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = collections.OrderedDict()
+            self.flush_scheduled = False
+            self.delivered += len(pending)
+        if pending:
+            try:
+                self.handler(pending)
+            except Exception as ex:
+                print(ex)
 
+    def stats(self):
+        with self.lock:
+            return {
+                "received": self.received,
+                "delivered": self.delivered,
+                "collapsed": self.collapsed,
+                "pending": len(self.pending),
+            }
 
-@attr.s
-class RuleSet(object):
-    name = attr.ib(default="r")
-    rules = attr.ib(default=attr.Factory(list))
-
-    def script(self, keyling=False, newlines=True):
-        scripts = "ruleset {} {{".format(self.name)
-        if newlines:
-            scripts += "\n"
-        for rule in self.rules:
-            if rule.enabled:
-                # suffix _ocr
-                scripts += "{source}_ocr {symbol} {values} -> {destination} {result}".format(
-                    **attr.asdict(rule.rule)
-                )
-                if newlines:
-                    scripts += "\n"
-        scripts += "}"
 
-        if keyling is True:
-            scripts = """($$(<"keli src-ruling-str [*] --db-port $DB_PORT --db-host $DB_HOST  --ruling-string '{}'">),)""".format(
-                scripts
-            )
+class DbEventListener(threading.Thread):
+    """Deliver pubsub messages to their handlers without polling
 
-        print(scripts)
-        return scripts
+    The thread blocks reading the pubsub socket and only wakes when
+    a message arrives. stop() unsubscribes from everything, the
+    server replies to that, which ends the blocking read.
+    """
 
+    def __init__(self, pubsub):
+        super(DbEventListener, self).__init__(daemon=True)
+        self.pubsub = pubsub
+        self.running = False
 
-@attr.s
-class Region(object):
-    name = attr.ib()
-    color = attr.ib(default="")
-    # x and y are upper left coordinates
-    x = attr.ib(default=0)
-    y = attr.ib(default=0)
-    w = attr.ib(default=0)
-    h = attr.ib(default=0)
-    scaling_x = attr.ib(default=1)
-    scaling_y = attr.ib(default=1)
+    def run(self):
+        self.running = True
+        try:
+            # listen calls the registered handler for each message
+            for _ in self.pubsub.listen():
+                if not self.running:
+                    break
+        except Exception as ex:
+            if self.running:
+                print(ex)
+        self.running = False
 
-    @property
-    def y2(self):
-        return self.y + self.h
+    def stop(self, timeout=1):
+        if self.running:
+            self.running = False
+            try:
+                self.pubsub.unsubscribe()
+                self.pubsub.punsubscribe()
+            except Exception:
+                pass
+            self.join(timeout)
+        self.pubsub.close()
 
-    @property
-    def x2(self):
-        return self.x + self.w
 
-    @property
-    def coordinates_unscaled(self):
-        return [self.x, self.y, self.w, self.h]
+class SourceSnapshot(object):
+    """In memory copy of a source hash
 
-    @property
-    def coordinates_scaled(self):
-        return [
-            int(self.x / self.scaling_x),
-            int(self.y / self.scaling_y),
-            int(self.w / self.scaling_x),
-            int(self.h / self.scaling_y),
-        ]
+    The hash is fetched on the first read and served from memory
+    until invalidate() is called, normally when a keyspace event
+    for the key arrives. version increases with every fetch.
+    """
 
-    def as_xml(self):
-        region = etree.Element("region")
-        for k, v in attr.asdict(self).items():
-            region.set(k, str(v))
-        # store properties, not needed for recreating object
-        coordinates_scaled = etree.Element("coordinates")
-        coordinates_scaled.set("scaled", "True")
-        coordinates_unscaled = etree.Element("coordinates")
-        coordinates_unscaled.set("scaled", "False")
-        for coords, coords_element in zip(
-            [self.coordinates_unscaled, self.coordinates_scaled],
-            [coordinates_unscaled, coordinates_scaled],
-        ):
-            for coord, coord_name in zip(coords, ["x", "y", "w", "h"]):
-                coords_element.set(coord_name, str(coord))
-        region.append(coordinates_unscaled)
-        region.append(coordinates_scaled)
-        return region
+    def __init__(self):
+        self.key = None
+        self.contents = None
+        self.version = 0
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if self.contents is not None and self.key == key:
+                self.hits += 1
+                return dict(self.contents)
+            self.misses += 1
+            invalidations = self.invalidations
+        contents = redis_conn.hgetall(key)
+        with self.lock:
+            # do not keep contents if invalidated while fetching
+            if invalidations == self.invalidations:
+                self.key = key
+                self.contents = contents
+                self.version += 1
+        return dict(contents)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None or key == self.key:
+                self.contents = None
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "key": self.key,
+                "version": self.version,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class SessionWriter(object):
+    """Collapse many session changes into a single write
+
+    mark() records a change, write is called flush_interval seconds
+    after the last change but never later than max_staleness seconds
+    after the first change that has not been written. Used from the
+    main thread only.
+    """
+
+    def __init__(self, write, flush_interval=0.5, max_staleness=2):
+        self.write = write
+        self.flush_interval = flush_interval
+        self.max_staleness = max_staleness
+        self.dirty_since = None
+        self.scheduled = None
+        self.marks = 0
+        self.writes = 0
+
+    def mark(self):
+        self.marks += 1
+        now = time.time()
+        if self.dirty_since is None:
+            self.dirty_since = now
+        if self.scheduled is not None:
+            self.scheduled.cancel()
+        delay = min(
+            self.flush_interval, max(0, self.dirty_since + self.max_staleness - now)
+        )
+        self.scheduled = Clock.schedule_once(lambda dt: self.flush(), delay)
+
+    def flush(self):
+        if self.scheduled is not None:
+            self.scheduled.cancel()
+            self.scheduled = None
+        if self.dirty_since is None:
+            return
+        self.dirty_since = None
+        self.writes += 1
+        self.write()
+
+
+class SourceSequence(object):
+    """Position in the ordered list of sources with neighbour prefetch
+
+    Images of up to window sources ahead and behind the current
+    one are fetched and decoded in the background so that stepping
+    through the list does not wait on the network or on decoding.
+    Neighbour hashes are only read for their image key, fields are
+    always shown from a fresh read since nothing invalidates them.
+    """
+
+    def __init__(self, sources_key, window=2):
+        self.sources_key = sources_key
+        self.window = window
+        self.position = None
+        self.length = 0
+        self.current = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.image_loader = ImageLoader(workers=1)
+
+    def locate(self, key):
+        sources = redis_conn.lrange(self.sources_key, 0, -1)
+        self.length = len(sources)
+        self.current = key
+        try:
+            self.position = sources.index(key)
+        except ValueError:
+            self.position = None
+        return self.position
+
+    def step(self, offset):
+        """Move offset places and return the new key, or None"""
+        if self.position is None or self.current is None:
+            if self.locate(self.current) is None:
+                return None
+        # fetch new position and its neighbours in one round trip
+        position = self.position + offset
+        start = max(0, position - self.window)
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.llen(self.sources_key)
+        pipe.lrange(self.sources_key, start, position + self.window)
+        self.length, keys = pipe.execute()
+        if not 0 <= position < self.length or position - start >= len(keys):
+            return None
+        self.position = position
+        self.current = keys[position - start]
+        return self.current
+
+    def neighbours(self):
+        if self.position is None:
+            return []
+        start = max(0, self.position - self.window)
+        keys = redis_conn.lrange(self.sources_key, start, self.position + self.window)
+        return [key for key in keys if key != self.current]
+
+    def prefetch(self, keys, key_field=None):
+        self.executor.submit(self._prefetch, keys, key_field)
+
+    def _prefetch(self, keys, key_field):
+        try:
+            pipe = redis_conn.pipeline(transaction=False)
+            for key in keys:
+                pipe.hgetall(key)
+            for key, source in zip(keys, pipe.execute()):
+                image_key = key if key_field is None else source.get(key_field)
+                if image_key:
+                    # warm the texture cache, nothing to display
+                    self.image_loader.load(
+                        ("prefetch", image_key), image_key, lambda texture: None
+                    )
+        except Exception as ex:
+            print(ex)
 
 
 class DropDownInput(TextInput):
@@ -267,9 +610,67 @@ class DropDownInput(TextInput):
         return super(DropDownInput, self).on_touch_up(touch)
 
 
+class FieldRow(RecycleDataViewBehavior, BoxLayout):
+    """Row view reused by EditViewViewer when virtualized"""
+
+    def __init__(self, **kwargs):
+        super(FieldRow, self).__init__(**kwargs)
+        self.viewer = None
+        self.index = None
+        self.field = None
+        self.refreshing = False
+        self.label = Label()
+        self.field_input = TextInput(
+            multiline=False, font_size=self.label.font_size / 1.5
+        )
+        self.field_input.bind(
+            on_text_validate=lambda widget: self.viewer.update_field(
+                self.field, widget.text, widget=widget
+            )
+        )
+        self.field_input.bind(text=self.on_field_text)
+        self.highlight = Button(text="$", size_hint_x=.1)
+        self.highlight.bind(
+            on_press=lambda widget: [
+                self.viewer.source_source.set_env_var("$SELECTED_KEY", self.field),
+                self.viewer.highlight_field(),
+            ]
+        )
+        remove_button = Button(text="X", size_hint_x=.1)
+        remove_button.bind(on_press=lambda widget: self.viewer.remove_field(self.field))
+        self.add_widget(self.label)
+        self.add_widget(self.field_input)
+        self.add_widget(self.highlight)
+        self.add_widget(remove_button)
+
+    def refresh_view_attrs(self, rv, index, data):
+        self.refreshing = True
+        self.index = index
+        self.viewer = data["viewer"]
+        self.field = data["field"]
+        self.label.text = str(data["field"])
+        self.field_input.text = data["text"]
+        if data["selected"]:
+            self.highlight.background_color = [0, 1, 0, 1]
+        else:
+            self.highlight.background_color = [1, 1, 1, 1]
+        self.refreshing = False
+
+    def on_field_text(self, widget, text):
+        # views are reused for other rows, keep typed text in the data
+        if not self.refreshing and self.viewer is not None:
+            self.viewer.recycle_view.data[self.index]["text"] = text
+
+
 class EditViewViewer(BoxLayout):
     def __init__(
-        self, view_source=None, config_hash=None, source_source=None, **kwargs
+        self,
+        view_source=None,
+        config_hash=None,
+        source_source=None,
+        virtualize_threshold=None,
+        write_mode="atomic",
+        **kwargs
     ):
         self.orientation = "vertical"
         # how to handle view_source update?
@@ -290,6 +691,18 @@ class EditViewViewer(BoxLayout):
             )
         )
         self.field_widgets = []
+        # field -> row, used to update rows in place
+        self.field_rows = collections.OrderedDict()
+        self.rows_key = None
+        # use a recycling view when there are more fields than
+        # virtualize_threshold, None to never use it
+        self.virtualize_threshold = virtualize_threshold
+        self.virtualized = False
+        self.recycle_view = None
+        # "atomic" or "optimistic", optimistic refuses to write
+        # if the hash changed since it was last read
+        self.write_mode = write_mode
+        self.base_source = self.db_fields(view_source)
         self.delete_source_button = Button(text="remove entire")
         self.delete_source_button.bind(on_press=lambda widget: self.delete_source())
 
@@ -331,49 +744,173 @@ class EditViewViewer(BoxLayout):
         except KeyError:
             pass
 
+    @staticmethod
+    def db_fields(source):
+        return {k: v for k, v in source.items() if not k.startswith("META_")}
+
+    def edited_fields(self):
+        # fields whose input differs from the last value read
+        if self.virtualized:
+            return set(
+                entry["field"]
+                for entry in self.recycle_view.data
+                if entry["text"] != entry["value"]
+            )
+        return set(
+            field
+            for field, row in self.field_rows.items()
+            if row.field_input.text != row.value
+        )
+
+    def advance_base(self, source):
+        """Take source as the base of fields that are not edited,
+        edited fields keep their base until written or discarded"""
+        edited = self.edited_fields()
+        fields = self.db_fields(source)
+        for field in set(fields) | set(self.base_source):
+            if field in edited:
+                continue
+            if field in fields:
+                self.base_source[field] = fields[field]
+            else:
+                self.base_source.pop(field)
+
     def update_field_rows(self, source=None):
-        self.fields_container.clear_widgets()
-        self.field_widgets = []
         if source:
+            if source.get("META_DB_KEY") == self.rows_key:
+                self.advance_base(source)
+            else:
+                self.base_source = self.db_fields(source)
             self.view_source = source
+        virtualized = (
+            self.virtualize_threshold is not None
+            and len(self.view_source) > self.virtualize_threshold
+        )
+        # rows of a different key are not reused
+        if (
+            self.view_source.get("META_DB_KEY", self.rows_key) != self.rows_key
+            or virtualized != self.virtualized
+        ):
+            self.fields_container.clear_widgets()
+            self.field_rows.clear()
+            if self.recycle_view is not None:
+                self.recycle_view.data = []
+            if virtualized:
+                self.fields_container.add_widget(self.get_recycle_view())
+        self.rows_key = self.view_source.get("META_DB_KEY", self.rows_key)
+        self.virtualized = virtualized
+
+        if virtualized:
+            self.update_recycled_rows()
+            return
+
+        for field in [f for f in self.field_rows if f not in self.view_source]:
+            self.fields_container.remove_widget(self.field_rows.pop(field))
+
         for field, value in self.view_source.items():
-            row = BoxLayout()
-            a = Label(text=str(field))
-            row.add_widget(a)
-            # dropdown?
-            field_input = TextInput(
-                text=str(value),
-                multiline=False,
-                height=a.height,
-                font_size=a.font_size / 1.5,
-            )
-            field_input.field_for = str(field)
-            field_input.bind(
-                on_text_validate=lambda widget, field=field, value=value: self.update_field(
-                    field, widget.text, widget=widget
-                )
+            value = str(value)
+            row = self.field_rows.get(field)
+            if row is None:
+                row = self.create_field_row(field, value)
+                self.field_rows[field] = row
+                self.fields_container.add_widget(row)
+            elif row.value != value:
+                # keep text that is being edited or was
+                # changed but not yet written
+                field_input = row.field_input
+                if not field_input.focus and field_input.text == row.value:
+                    field_input.text = value
+                row.value = value
+
+        self.field_widgets = [row.field_input for row in self.field_rows.values()]
+        self.highlight_field()
+
+    def get_recycle_view(self):
+        if self.recycle_view is None:
+            self.recycle_view = RecycleView()
+            self.recycle_view.viewclass = FieldRow
+            layout = RecycleBoxLayout(
+                orientation="vertical",
+                default_size=(None, 30),
+                default_size_hint=(1, None),
+                size_hint_y=None,
             )
-            field_highlight_button = Button(text="$", size_hint_x=.1)
-            field_highlight_button.bind(
-                on_press=lambda widget, field=field: [
-                    self.source_source.set_env_var("$SELECTED_KEY", field),
-                    self.highlight_field(),
-                ]
+            layout.bind(minimum_height=layout.setter("height"))
+            self.recycle_view.add_widget(layout)
+        return self.recycle_view
+
+    def update_recycled_rows(self):
+        # only visible rows have widgets, the rest is plain data
+        previous = {entry["field"]: entry for entry in self.recycle_view.data}
+        selected = self.selected_field()
+        data = []
+        for field, value in self.view_source.items():
+            value = str(value)
+            text = value
+            entry = previous.get(field)
+            # keep text that was changed but not yet written
+            if entry is not None and entry["text"] != entry["value"]:
+                text = entry["text"]
+            data.append(
+                {
+                    "viewer": self,
+                    "field": field,
+                    "value": value,
+                    "text": text,
+                    "selected": field == selected,
+                }
             )
-            field_remove_button = Button(text="X", size_hint_x=.1)
-            field_remove_button.bind(
-                on_press=lambda widget, field=field: self.remove_field(field)
+        self.recycle_view.data = data
+
+    def selected_field(self):
+        try:
+            return self.source_source.env_vars()["$SELECTED_KEY"]
+        except Exception:
+            return None
+
+    def create_field_row(self, field, value):
+        row = BoxLayout()
+        a = Label(text=str(field))
+        row.add_widget(a)
+        # dropdown?
+        field_input = TextInput(
+            text=value, multiline=False, height=a.height, font_size=a.font_size / 1.5
+        )
+        field_input.field_for = str(field)
+        field_input.bind(
+            on_text_validate=lambda widget, field=field: self.update_field(
+                field, widget.text, widget=widget
             )
-            row.add_widget(field_input)
-            row.highlight = field_highlight_button
-            row.field = field
-            row.add_widget(field_highlight_button)
-            row.add_widget(field_remove_button)
-            self.fields_container.add_widget(row)
-            self.field_widgets.append(field_input)
-        self.highlight_field()
+        )
+        field_highlight_button = Button(text="$", size_hint_x=.1)
+        field_highlight_button.bind(
+            on_press=lambda widget, field=field: [
+                self.source_source.set_env_var("$SELECTED_KEY", field),
+                self.highlight_field(),
+            ]
+        )
+        field_remove_button = Button(text="X", size_hint_x=.1)
+        field_remove_button.bind(
+            on_press=lambda widget, field=field: self.remove_field(field)
+        )
+        row.add_widget(field_input)
+        row.highlight = field_highlight_button
+        row.field = field
+        row.field_input = field_input
+        # last value from source, to detect local edits
+        row.value = value
+        row.add_widget(field_highlight_button)
+        row.add_widget(field_remove_button)
+        return row
 
     def highlight_field(self):
+        if self.virtualized:
+            selected = self.selected_field()
+            for entry in self.recycle_view.data:
+                entry["selected"] = entry["field"] == selected
+            self.recycle_view.refresh_from_data()
+            return
+
         for widget in self.fields_container.children:
             try:
                 if widget.field == self.source_source.env_vars()["$SELECTED_KEY"]:
@@ -398,9 +935,14 @@ class EditViewViewer(BoxLayout):
         #
         # for now, still require enter to be pressed for META_
         # prefixed fields since it may disrupt values such as ttl
-        for w in self.field_widgets:
-            if "META_" not in w.field_for:
-                self.update_field(w.field_for, w.text, w)
+        if self.virtualized:
+            for entry in self.recycle_view.data:
+                if "META_" not in entry["field"]:
+                    self.update_field(entry["field"], entry["text"])
+        else:
+            for w in self.field_widgets:
+                if "META_" not in w.field_for:
+                    self.update_field(w.field_for, w.text, w)
 
         key_to_write = self.view_source.pop("META_DB_KEY")
         key_expiration = None
@@ -414,50 +956,92 @@ class EditViewViewer(BoxLayout):
         for key in list(self.view_source.keys()):
             if key.startswith("META_"):
                 self.view_source.pop(key)
-        redis_conn.hmset(key_to_write, self.view_source)
-
-        # if a field has been deleted in ui, delete it from hash
-        for key in set(redis_conn.hgetall(key_to_write).keys()) - set(
-            self.view_source.keys()
-        ):
-            print("removing {}".format(key))
-            redis_conn.hdel(key_to_write, key)
 
-        if key_expiration and key_expiration > 0:
-            redis_conn.expire(key_to_write, key_expiration)
+        if self.write_mode == "optimistic":
+            conflicts = write_hash_watched(
+                key_to_write, self.view_source, self.base_source, key_expiration
+            )
+            if conflicts:
+                print("not written, changed by others: {}".format(sorted(conflicts)))
+                current_background = self.write_fields_button.background_color
+                anim = Animation(
+                    background_color=[1, 0, 0, 1], duration=0.5
+                ) + Animation(background_color=current_background, duration=0.5)
+                anim.start(self.write_fields_button)
+                # keep meta fields so a later write can be retried
+                self.view_source["META_DB_KEY"] = key_to_write
+                if key_expiration is not None:
+                    self.view_source["META_DB_TTL"] = str(key_expiration)
+                return
+        else:
+            # if a field has been deleted in ui, it is deleted from hash
+            removed = write_hash(key_to_write, self.view_source, key_expiration)
+            for key in removed:
+                print("removing {}".format(key))
+        self.base_source = dict(self.view_source)
 
 
 class ClickableImage(Image):
     def __init__(self, **kwargs):
         self.key = None
         self.key_field = None
+        self.snapshot = SourceSnapshot()
+        # decode on a worker thread when reloading
+        self.async_load = True
         self.selection_mode_selections = []
         super(ClickableImage, self).__init__(**kwargs)
 
     def reload(self):
-        self.db_load(self.key, self.key_field)
+        if self.async_load:
+            self.db_load_async(self.key, self.key_field)
+        else:
+            self.db_load(self.key, self.key_field)
+
+    def db_load_async(self, key, key_field=None):
+        self.key = key
+        self.key_field = key_field
+        image_key = None
+        if key_field is None:
+            image_key = key
+        image_loader.load(
+            self, image_key, self.set_texture, key=key, key_field=key_field
+        )
+
+    def set_texture(self, texture):
+        self.texture = texture
+        self.size = self.norm_image_size
 
     def db_load(self, key, key_field=None):
         self.key = key
         self.key_field = key_field
         if key_field is None:
-            image_data = load_image(key)
+            image_key = key
         else:
-            image_data = load_image(self.key_reference)
+            image_key = self.key_reference
 
         try:
-            self.texture = CoreImage(image_data, ext="jpg").texture
+            # cached textures are dropped when their key changes
+            version = texture_cache.version()
+            texture = texture_cache.get(image_key)
+            if texture is None:
+                image_data = load_image(image_key)
+                with profile.timed("first image decode", once=True):
+                    texture = CoreImage(image_data, ext="jpg").texture
+                texture_cache.put(image_key, texture, version)
+            self.texture = texture
             self.size = self.norm_image_size
         except Exception as ex:
             print(ex)
 
     @property
     def key_reference(self):
-        return redis_conn.hget(self.key, self.key_field)
+        if self.key_field is None:
+            return None
+        return self.snapshot.get(self.key).get(self.key_field)
 
     @property
     def key_value(self):
-        k = redis_conn.hgetall(self.key)
+        k = self.snapshot.get(self.key)
         k.update({"META_DB_KEY": self.key})
         return k
 
@@ -600,7 +1184,7 @@ class ClickableImage(Image):
                                 self.app.default_region_page.regions.append(region)
                                 # a region has been added update xml
                                 # and write session to db
-                                self.app.session_to_db()
+                                self.app.session_changed()
                                 # crop_rect = (
                                 #     int(x1 / scale_x),
                                 #     int(y1 / scale_y),
@@ -609,22 +1193,9 @@ class ClickableImage(Image):
                                 # )
                                 # self.selection_mode_selections = []
                                 self.script.script_input.text = ""
-                                if self.script.run_single_page_only:
-                                    scripts = self.app.default_region_page.scripts
-                                    rule_scripts = self.app.default_region_page.rules_widget.ruleset.script(
-                                        keyling=True, newlines=False
-                                    )
-                                else:
-                                    scripts = ""
-                                    rule_scripts = ""
-                                    for r in self.app.region_pages:
-                                        scripts += r.scripts + "\n"
-                                        rule_scripts += r.rules_widget.ruleset.script(
-                                            keyling=True, newlines=False
-                                        )
+                                scripts, rule_scripts = self.generated_scripts()
                                 if self.script.auto_run_scripts is True:
-                                    self.script.run(scripts)
-                                    self.script.run(rule_scripts)
+                                    self.script.run_changed(self.script_region_pages())
                                 self.script.script_input.text += scripts + "\n"
                                 self.script.script_input.text += rule_scripts
                                 self.draw_regions()
@@ -638,22 +1209,18 @@ class ClickableImage(Image):
                                 )
                                 anim.start((self.app.region_page))
 
+    def script_region_pages(self):
+        if self.script.run_single_page_only:
+            return [self.app.default_region_page]
+        return self.app.region_pages
+
+    def generated_scripts(self):
+        return generate_scripts(self.script_region_pages())
+
     def update_region_scripts(self):
         # used when a region is removed
         self.script.script_input.text = ""
-        scripts = ""
-        rule_scripts = ""
-        if self.script.run_single_page_only:
-            scripts = self.app.default_region_page.scripts
-            rule_scripts = self.app.default_region_page.rules_widget.ruleset.script(
-                keyling=True, newlines=False
-            )
-        else:
-            for r in self.app.region_pages:
-                scripts += r.scripts + "\n"
-                rule_scripts += r.rules_widget.ruleset.script(
-                    keyling=True, newlines=False
-                )
+        scripts, rule_scripts = self.generated_scripts()
         self.script.script_input.text += scripts + "\n"
         self.script.script_input.text += rule_scripts
 
@@ -685,7 +1252,7 @@ class RuleWidgets(BoxLayout):
         self.ruleset = RuleSet()
         self.app = app
         types_container = BoxLayout(orientation="vertical")
-        for rule_type in ("int", "str", "roman", "Range", "STRING"):
+        for rule_type in RULE_TYPES:
             row = BoxLayout(orientation="horizontal", size_hint_y=None, height=30)
             rule_toggle = ToggleButton(text=rule_type, size_hint_x=None)
             row.add_widget(rule_toggle)
@@ -729,7 +1296,7 @@ class RuleWidgets(BoxLayout):
         # the on_press call does not change it before calls to session_to_db
         # add a slight delay for now
         if update_session:
-            Clock.schedule_once(lambda dt: self.app.session_to_db(), .1)
+            Clock.schedule_once(lambda dt: self.app.session_changed(), .1)
 
     def as_xml(self):
         rules = []
@@ -762,6 +1329,19 @@ class ScriptBox(BoxLayout):
         self.script_input = TextInput(hint_text="()", multiline=True, size_hint_y=1)
         self.auto_run_scripts = True
         self.run_single_page_only = False
+        # number of source hashes fetched per round trip
+        self.batch_size = 500
+        # run on all settings, pool is "thread" or "process"
+        self.workers = os.cpu_count() or 1
+        self.pool = "thread"
+        # "inprocess" crops regions with one decode per source,
+        # "keli" crops each region in a keli subprocess
+        self.crop_engine = "inprocess"
+        # used by the inprocess crop engine, None disables
+        self.ocr_cache = None
+        # steps that ran on each source, for auto run
+        self.planner = StepPlanner()
+        self.runner = None
         self.sync_with_others = True
         self.run_script_this_button = Button(
             text="run script on this", size_hint_y=None, height=30
@@ -777,6 +1357,22 @@ class ScriptBox(BoxLayout):
             height=30,
         )
         self.run_script_all_button.bind(on_press=lambda widget: self.run_on_all())
+        self.run_regions_all_button = Button(
+            text="run regions and rules on all", size_hint_y=None, height=30
+        )
+        self.run_regions_all_button.bind(
+            on_press=lambda widget: self.run_regions_on_all()
+        )
+        self.run_progress = Label(text="", size_hint_x=.8)
+        self.run_cancel_button = Button(text="cancel", size_hint_x=.2)
+        self.run_cancel_button.bind(on_press=lambda widget: self.cancel_run_on_all())
+        # auto run jobs, status changes come from the job thread
+        self.jobs = JobQueue(
+            on_change=lambda job: Clock.schedule_once(self.update_job_status)
+        )
+        self.job_status = Label(text="", size_hint_x=.8)
+        self.job_cancel_button = Button(text="cancel jobs", size_hint_x=.2)
+        self.job_cancel_button.bind(on_press=lambda widget: self.jobs.cancel())
         self.script_regenerate_button = Button(
             text="regenerate scripts", size_hint_y=None, height=30
         )
@@ -827,17 +1423,156 @@ class ScriptBox(BoxLayout):
         self.add_widget(self.script_input)
         self.add_widget(self.run_script_this_button)
         self.add_widget(self.run_script_all_button)
+        self.add_widget(self.run_regions_all_button)
+        run_progress_row = BoxLayout(
+            orientation="horizontal", height=30, size_hint_y=None
+        )
+        run_progress_row.add_widget(self.run_progress)
+        run_progress_row.add_widget(self.run_cancel_button)
+        self.add_widget(run_progress_row)
+        job_row = BoxLayout(orientation="horizontal", height=30, size_hint_y=None)
+        job_row.add_widget(self.job_status)
+        job_row.add_widget(self.job_cancel_button)
+        self.add_widget(job_row)
         self.add_widget(self.script_regenerate_button)
 
     def run_on_all(self):
-        sources = redis_conn.lrange(self.all_sources_key, 0, -1)
-        for position, s in enumerate(sources):
-            source = redis_conn.hgetall(s)
-            source.update({"META_DB_KEY": s})
-            print("{} {}".format(position, s))
-            self.run_script(
-                self.script_input.text, widget=self.script_input, source=source
+        # exactly what is in the box
+        self.start_runner(self.script_input.text)
+
+    def run_regions_on_all(self):
+        """Crop, ocr and rule all sources with the regions and
+        rulesets of the session, using the crop engine"""
+        region_pages = self.source_widget.script_region_pages()
+        region_scripts, rule_scripts = generate_scripts(region_pages)
+        scripts = []
+        crops = None
+        if self.crop_engine == "inprocess":
+            crops = crop.crop_plan(region_pages)
+        else:
+            scripts.append(region_scripts)
+        scripts.append(rule_scripts)
+        self.start_runner(scripts, crops=crops)
+
+    def start_runner(self, script, crops=None):
+        if self.runner is not None and self.runner.running:
+            return
+        self.runner = SourceRunner(
+            script,
+            self.all_sources_key,
+            self.env_vars,
+            workers=self.workers,
+            pool=self.pool,
+            batch_size=self.batch_size,
+            errors_key=self.run_errors_key,
+            crops=crops,
+            key_field=self.source_widget.key_field,
+            ocr_cache=self.ocr_cache,
+        )
+        self.runner.start()
+        Clock.schedule_interval(self.update_run_progress, 0.5)
+
+    def run_changed(self, region_pages):
+        """Queue the crop, ocr and ruling steps affected by edits
+        since they last ran on this source
+
+        Steps are planned here and run on the job queue, results
+        show up through db events. A newer edit of the same source
+        supersedes a job that has not started.
+        """
+        source = dict(self.source_widget.key_value)
+        key = source["META_DB_KEY"]
+        plan = self.planner.plan(key, self.source_widget.key_reference, region_pages)
+        if not plan:
+            return
+        env_vars = self.env_vars(key)
+        steps = []
+        if plan.regions and self.crop_engine == "inprocess":
+            steps.append(
+                functools.partial(
+                    run_regions,
+                    source,
+                    env_vars,
+                    plan.regions,
+                    self.source_widget.key_field,
+                    self.ocr_cache,
+                )
+            )
+        elif plan.regions:
+            script = (
+                "("
+                + "".join(
+                    crop_script(name, coordinates) + "\n" + ocr_script(name)
+                    for name, coordinates in plan.regions
+                )
+                + ")"
             )
+            steps.append(functools.partial(run_keyling, script, source, env_vars))
+        if plan.rule_pages:
+            script = "".join(
+                region_page.rules_widget.ruleset.script(keyling=True, newlines=False)
+                for region_page in plan.rule_pages
+            )
+            # sees what the region steps wrote
+            steps.append(lambda: run_keyling(script, fetch_source(key), env_vars))
+
+        def run_steps(job):
+            for step in steps:
+                if job.cancelled.is_set():
+                    return
+                step()
+            self.planner.done(plan)
+
+        self.jobs.submit(
+            run_steps,
+            group=key,
+            description="{} regions {} rulesets".format(
+                len(plan.regions), len(plan.rule_pages)
+            ),
+        )
+
+    def update_job_status(self, dt=None):
+        self.job_status.text = "  ".join(
+            "#{} {} {} {:.1f}s".format(job.id, job.description, job.status, job.elapsed)
+            for job in self.jobs.recent()
+        )
+
+    def cancel_run_on_all(self):
+        if self.runner is not None:
+            self.runner.cancel()
+
+    def update_run_progress(self, dt=None):
+        progress = self.runner.progress()
+        eta = "-"
+        if progress["eta"] is not None:
+            eta = "{:.0f}s".format(progress["eta"])
+        state = ""
+        if progress["cancelled"]:
+            state = " cancelled"
+        if progress["error"] is not None:
+            state = " failed: {}".format(progress["error"].partition("\n")[0])
+        self.run_progress.text = "{}/{} done {} failed {:.1f}/s eta {}{}".format(
+            progress["done"],
+            progress["total"],
+            progress["failed"],
+            progress["rate"],
+            eta,
+            state,
+        )
+        # returning False unschedules the interval
+        return self.runner.running
+
+    @property
+    def run_errors_key(self):
+        db_port = redis_conn.connection_pool.connection_kwargs["port"]
+        db_host = redis_conn.connection_pool.connection_kwargs["host"]
+        return "dzz:run_errors:{host}:{port}".format(host=db_host, port=db_port)
+
+    @property
+    def ocr_cache_key(self):
+        db_port = redis_conn.connection_pool.connection_kwargs["port"]
+        db_host = redis_conn.connection_pool.connection_kwargs["host"]
+        return "dzz:ocr_cache:{host}:{port}".format(host=db_host, port=db_port)
 
     @property
     def all_sources_key(self):
@@ -845,7 +1580,7 @@ class ScriptBox(BoxLayout):
         db_host = redis_conn.connection_pool.connection_kwargs["host"]
         return "machinic:structured:{host}:{port}".format(host=db_host, port=db_port)
 
-    def env_vars(self, source_uuid=None):
+    def env_vars(self, source_uuid=None, position=None):
         db_port = redis_conn.connection_pool.connection_kwargs["port"]
         db_host = redis_conn.connection_pool.connection_kwargs["host"]
         env_vars = {
@@ -855,7 +1590,9 @@ class ScriptBox(BoxLayout):
         }
         # try to get position from fold-ui
         # may not be up-to-date
-        if source_uuid is not None:
+        if position is not None:
+            env_vars.update({"$SEQUENCE": position})
+        elif source_uuid is not None:
             try:
                 source_position = redis_conn.lrange(self.all_sources_key, 0, -1).index(
                     source_uuid
@@ -873,7 +1610,7 @@ class ScriptBox(BoxLayout):
             model = None
             source_modified = None
             try:
-                model = keyling.model(script)
+                model = compile_script(script)
                 anim = Animation(
                     background_color=[0, 1, 0, 1], duration=0.5
                 ) + Animation(background_color=current_background, duration=0.5)
@@ -886,66 +1623,69 @@ class ScriptBox(BoxLayout):
 
             if model:
                 if source is None:
-                    source_modified = keyling.parse_lines(
-                        model,
-                        self.source_widget.key_value,
-                        self.source_widget.key_value["META_DB_KEY"],
-                        allow_shell_calls=True,
-                        env_vars=self.env_vars(
-                            self.source_widget.key_value["META_DB_KEY"]
-                        ),
-                        source_updates=self.latest_source,
-                    )
-                else:
-                    source_modified = keyling.parse_lines(
-                        model,
-                        source,
-                        source["META_DB_KEY"],
-                        allow_shell_calls=True,
-                        env_vars=self.env_vars(source["META_DB_KEY"]),
-                        source_updates=self.latest_source,
-                    )
+                    source = self.source_widget.key_value
+                source_modified = keyling.parse_lines(
+                    model,
+                    source,
+                    source["META_DB_KEY"],
+                    allow_shell_calls=True,
+                    env_vars=self.env_vars(source["META_DB_KEY"]),
+                    source_updates=self.latest_source,
+                )
                 print(source_modified)
 
             widget.background_color = [1, 1, 1, 1]
 
-    def run(self, script):
-        model = None
-        try:
-            model = keyling.model(script)
-        except Exception as ex:
-            print(ex)
-            pass
-        if model:
-            source_modified = keyling.parse_lines(
-                model,
-                self.source_widget.key_value,
-                self.source_widget.key_value["META_DB_KEY"],
-                allow_shell_calls=True,
-                env_vars=self.env_vars(self.source_widget.key_value["META_DB_KEY"]),
-                source_updates=self.latest_source,
-            )
-            print(source_modified)
-
     def latest_source(self):
-        return redis_conn.hgetall(self.source_widget.key_value["META_DB_KEY"])
+        # updates made while a script runs, not served from snapshot
+        return redis_conn.hgetall(self.source_widget.key)
 
 
 class DzzApp(App):
     def __init__(self, *args, **kwargs):
         # store kwargs to passthrough
         self.kwargs = kwargs
-        self.region_pages = []
+        self.region_pages = NamedList()
         self.default_region_page = None
         self.session_key_template = "dzz:session:{host}:{port}"
-        if kwargs["db_host"] and kwargs["db_port"]:
-            global binary_r
-            global redis_conn
-            db_settings = {"host": kwargs["db_host"], "port": kwargs["db_port"]}
-            binary_r = redis.StrictRedis(**db_settings)
-            redis_conn = redis.StrictRedis(**db_settings, decode_responses=True)
+        self.db_index = kwargs.get("db") or 0
+        # connections are created on first use, discovery is
+        # only needed if host and port are not given
+        db.configure(host=kwargs["db_host"], port=kwargs["db_port"], db=self.db_index)
+        if profile.enabled:
+            with profile.timed("first db round trip"):
+                redis_conn.ping()
         self.db_port = redis_conn.connection_pool.connection_kwargs["port"]
         self.db_host = redis_conn.connection_pool.connection_kwargs["host"]
+        self.keyspace_prefix = "__keyspace@{}__:".format(self.db_index)
+        self.subscribed_keys = set()
+        # "xml" writes the whole session document, "oplog" appends
+        # changes to a stream that is compacted into the document
+        self.session_sync = kwargs.get("session_sync") or "xml"
+        self.session_compact_threshold = kwargs.get("session_compact") or 200
+        # last applied stream id and last published entries
+        self.session_version = "0-0"
+        # tags session writes to recognize them when they come back
+        self.origin = str(uuid.uuid4())
+        # last version of the xml session document applied or written
+        self.session_document_version = 0
+        self.published_entries = collections.OrderedDict()
+        self.session_writer = SessionWriter(
+            self.session_to_db,
+            flush_interval=kwargs.get("session_flush") or 0,
+            max_staleness=kwargs.get("session_max_staleness") or 0,
+        )
+        self.db_events = EventCoalescer(
+            self.apply_db_events, window=kwargs.get("event_window") or 0
+        )
+        self.sequence = SourceSequence(
+            "machinic:structured:{host}:{port}".format(
+                host=self.db_host, port=self.db_port
+            ),
+            window=kwargs.get("prefetch") or 0,
+        )
+        if kwargs.get("texture_cache_mb") is not None:
+            texture_cache.max_bytes = kwargs["texture_cache_mb"] * 1024 * 1024
         super(DzzApp, self).__init__()
 
     @property
@@ -953,31 +1693,154 @@ class DzzApp(App):
         return self.session_key_template.format(host=self.db_host, port=self.db_port)
 
     def save_session(self):
-        pass
+        # write any pending session changes
+        self.session_writer.flush()
+
+    def session_changed(self):
+        self.session_writer.mark()
+
+    def step_source(self, offset):
+        key = self.sequence.step(offset)
+        if key is None:
+            return
+        self.show_source(key)
+
+    def show_source(self, key):
+        self.img.db_load_async(key, self.img.key_field)
+        # read through the snapshot, events keep it current
+        self.fields.update_field_rows(self.img.key_value)
+        self.retarget_subscriptions()
+        self.update_sequence_position()
+        if self.sequence.window:
+            self.sequence.prefetch(self.sequence.neighbours(), self.img.key_field)
+
+    def update_sequence_position(self):
+        if self.sequence.position is None:
+            self.sequence_position.text = "not in {}".format(self.sequence.sources_key)
+        else:
+            self.sequence_position.text = "{} / {}".format(
+                self.sequence.position + 1, self.sequence.length
+            )
+
+    def on_start(self):
+        if profile.enabled:
+            self.root_window.bind(on_flip=self.on_first_frame)
+
+    def on_first_frame(self, window):
+        window.unbind(on_flip=self.on_first_frame)
+        profile.record("first frame")
+        profile.report()
 
     def on_stop(self):
+        self.save_session()
         # stop pubsub thread if window closed with '[x]'
         self.db_event_subscription.thread.stop()
+        self.img.script.jobs.stop()
 
     def app_exit(self):
         self.db_event_subscription.thread.stop()
+        self.img.script.jobs.stop()
         App.get_running_app().stop()
 
-    def handle_db_events(self, message):
-        msg = message["channel"].replace("__keyspace@0__:", "")
-        if msg in (self.img.key, self.img.key_reference):
-            Clock.schedule_once(lambda dt: self.img.reload(), .1)
+    def retarget_subscriptions(self):
+        """Subscribe to keyspace events of the current key, its
+        referenced image and the session only"""
+        keys = set([self.img.key, self.img.key_reference, self.session_key])
+        if self.session_sync == "oplog":
+            keys.add(self.session_ops_key)
+        keys.discard(None)
+        subscribe = keys - self.subscribed_keys
+        unsubscribe = self.subscribed_keys - keys
+        if unsubscribe:
+            self.db_event_subscription.unsubscribe(
+                *[self.keyspace_prefix + key for key in unsubscribe]
+            )
+        if subscribe:
+            self.db_event_subscription.subscribe(
+                **{
+                    self.keyspace_prefix + key: self.handle_db_events
+                    for key in subscribe
+                }
+            )
+        self.subscribed_keys = keys
 
-        if msg in (self.img.key):
+    def handle_db_events(self, message):
+        # called from pubsub thread, events are applied in batches
+        # on the main thread by apply_db_events
+        msg = message["channel"].replace(self.keyspace_prefix, "", 1)
+        if msg not in self.subscribed_keys:
+            # late event from a key that is no longer followed
+            return
+        # stop serving the old snapshot right away, before
+        # the batched update on the main thread
+        self.img.snapshot.invalidate(msg)
+        self.db_events.add(msg, message["data"])
+
+    def handle_image_events(self, message):
+        # called from pubsub thread, the data is the key
+        texture_cache.invalidate(message["data"])
+
+    def apply_db_events(self, events):
+        # a burst of events results in at most one reload,
+        # one field refresh and one session update
+        image_reference = self.img.key_reference
+        if image_reference in events:
+            texture_cache.invalidate(image_reference)
+
+        if self.img.key in events or image_reference in events:
+            self.img.reload()
+
+        if self.img.key in events:
+            # the image reference field may have changed
+            self.retarget_subscriptions()
             self.fields.update_field_rows(self.img.key_value)
 
-        if msg in (self.session_key):
-            Clock.schedule_once(
-                lambda dt, msg=msg: self.update_session(
-                    etree.fromstring(redis_conn.hget(msg, "xml"))
-                ),
-                .1,
-            )
+        if self.session_ops_key in events and self.session_writer.dirty_since:
+            # publish local changes first, own ops are applied
+            # again with the ops of peers
+            self.session_writer.flush()
+
+        if self.session_key in events and self.session_sync == "xml":
+            self.update_session_from_db()
+
+        if self.session_ops_key in events:
+            self.sync_session_ops()
+
+    def update_session_from_db(self):
+        # check who wrote before fetching and parsing the document
+        origin, version = redis_conn.hmget(self.session_key, "origin", "version")
+        version = int(version or 0)
+        if origin == self.origin or (
+            version and version <= self.session_document_version
+        ):
+            return
+        xml = redis_conn.hget(self.session_key, "xml")
+        if xml is None:
+            return
+        self.session_document_version = version
+        changes = []
+        if self.session_writer.dirty_since is not None:
+            # changes that are not written yet are made again on
+            # top of the document of the peer and written later
+            _, changes = self.session_changes()
+        xml = etree.fromstring(xml)
+        self.update_session(xml)
+        for op, (kind, page, entry_id), entry_xml in changes:
+            try:
+                self.apply_session_op(
+                    {
+                        "op": op,
+                        "kind": kind,
+                        "page": page,
+                        "id": entry_id,
+                        "xml": entry_xml,
+                    }
+                )
+            except Exception as ex:
+                print(ex)
+        if changes:
+            self.redraw_session()
+        self.published_entries = self.session_entries(xml)
 
     def update_session(self, xml):
         if self.img.script.sync_with_others:
@@ -988,116 +1851,254 @@ class DzzApp(App):
         for session in xml.xpath("//session"):
             for regionpage_xml in session.xpath("./regionpage"):
                 # create/update regionpages
-                name = str(regionpage_xml.xpath("./@name")[0])
-                color = str(regionpage_xml.xpath("./@color")[0])
-                if name not in [region_page.name for region_page in self.region_pages]:
-                    regionpage = RegionPage(
-                        name=name,
-                        color=colour.Color(color),
-                        rules_widget=RuleWidgets(app=self),
-                    )
-                    self.region_pages.append(regionpage)
-                    # insert name into dropdown
-                    self.region_page.text = regionpage.name
-                    self.region_page.dispatch("on_text_validate")
-
-                    if self.default_region_page is None:
-                        self.default_region_page = regionpage
-                        self.region_page.text = regionpage.name
-                        # validate to enter in dropdown
-                        self.region_page.dispatch("on_text_validate")
-                        self.update_regions()
-                        self.rule_box.load_rules(self.default_region_page.rules_widget)
-                    else:
-                        # set dropdown name back to default
-                        self.region_page.text = self.default_region_page.name
-                else:
-                    regionpage = [
-                        region_page
-                        for region_page in self.region_pages
-                        if region_page.name == name
-                    ][0]
-
-                # create/update regions
-                # use to delete existing regions
-                created_regions = set()
-                for region_xml in regionpage_xml.xpath("./region"):
-                    r = {}
-                    # use a copy of region attributes
-                    r = dict(region_xml.attrib)
-
-                    # try to convert back ints and floats
-                    for k, v in r.items():
-                        try:
-                            r[k] = int(v)
-                        except Exception as ex:
-                            try:
-                                r[k] = float(v)
-                            except Exception as ex:
-                                pass
-                            pass
-
-                    r = Region(**r)
-                    print("region from xml: ", r)
-                    created_regions.add(r.name)
-                    if r.name in [region.name for region in regionpage.regions]:
-                        to_remove = [
-                            region
-                            for region in regionpage.regions
-                            if region.name == r.name
-                        ][0]
-                        regionpage.regions.remove(to_remove)
-                        regionpage.regions.append(r)
-                    else:
-                        regionpage.regions.append(r)
-
-                for rule_xml in regionpage_xml.xpath("//rule"):
-                    # create/update rules
-                    rule = dict(rule_xml.attrib)
-                    for r in regionpage.rules_widget.ruleset.rules:
-                        # rule widgets already exist, they are created
-                        # by parent widget, match using values and then
-                        # update
-                        if r.values_widget.text == rule["values"]:
-                            r.destination_widget.text = rule["destination"]
-                            r.result_widget.text = rule["result"]
-                            if rule["enabled"].lower() == "true":
-                                enabled_state = True
-                            else:
-                                enabled_state = False
-                            r.enabled_widget.pressed = enabled_state
-                            # update to toggle enabled correctly...
-                            r.enabled_widget.draw_pressed_state()
-                            # set toggle_row state too
-                            regionpage.rules_widget.toggle_row(
-                                r.enabled_widget,
-                                r.enabled_widget.setting_row,
-                                update_session=False,
-                            )
+                regionpage = self.apply_regionpage_xml(regionpage_xml)
 
-                # remove regions if needed
-                existing_regions = set([region.name for region in regionpage.regions])
-                remove_regions = existing_regions - created_regions
-                print("removing ", remove_regions, existing_regions, created_regions)
-                for region in list(regionpage.regions):
-                    if region.name in remove_regions:
-                        regionpage.regions.remove(region)
+                # create/update regions, remove the ones not
+                # in the xml
+                removed_regions = update_regions_from_xml(
+                    regionpage, regionpage_xml.xpath("./region")
+                )
+                print("removed ", removed_regions)
+
+                for rule_xml in regionpage_xml.xpath("./rule"):
+                    # create/update rules of this regionpage only
+                    self.apply_rule_xml(regionpage, rule_xml)
+
+        self.redraw_session()
 
+    def redraw_session(self):
         self.update_regions()
         # call draw_regions with a slight delay to
         # make sure canvas is loaded, otherwise rectangles
         # are drawn with incorrect coordinates
         Clock.schedule_once(lambda dt: self.img.draw_regions(), 0.5)
 
+    def apply_regionpage_xml(self, regionpage_xml):
+        name = str(regionpage_xml.xpath("./@name")[0])
+        color = str(regionpage_xml.xpath("./@color")[0])
+        regionpage = self.region_pages.get(name)
+        if regionpage is None:
+            regionpage = RegionPage(
+                name=name, color=colour.Color(color), rules_widget=RuleWidgets(app=self)
+            )
+            self.region_pages.append(regionpage)
+            # insert name into dropdown
+            self.region_page.text = regionpage.name
+            self.region_page.dispatch("on_text_validate")
+
+            if self.default_region_page is None:
+                self.default_region_page = regionpage
+                self.region_page.text = regionpage.name
+                # validate to enter in dropdown
+                self.region_page.dispatch("on_text_validate")
+                self.update_regions()
+                self.rule_box.load_rules(self.default_region_page.rules_widget)
+            else:
+                # set dropdown name back to default
+                self.region_page.text = self.default_region_page.name
+        return regionpage
+
+    def apply_rule_xml(self, regionpage, rule_xml):
+        rule = dict(rule_xml.attrib)
+        for r in regionpage.rules_widget.ruleset.rules:
+            # rule widgets already exist, they are created
+            # by parent widget, match using values and then
+            # update
+            if r.values_widget.text == rule["values"]:
+                r.destination_widget.text = rule["destination"]
+                r.result_widget.text = rule["result"]
+                if rule["enabled"].lower() == "true":
+                    enabled_state = True
+                else:
+                    enabled_state = False
+                r.enabled_widget.pressed = enabled_state
+                # update to toggle enabled correctly...
+                r.enabled_widget.draw_pressed_state()
+                # set toggle_row state too
+                regionpage.rules_widget.toggle_row(
+                    r.enabled_widget, r.enabled_widget.setting_row, update_session=False
+                )
+
+    def session_entries(self, xml=None):
+        """Serialized regionpages, regions and rules of the session,
+        or of a session xml, by (kind, regionpage name, id), used
+        to diff sessions. Regions are identified by their id, rules
+        by their values and regionpages by their name"""
+        if xml is None:
+            xml = self.as_xml()
+        entries = collections.OrderedDict()
+        for regionpage_xml in xml.xpath("//session/regionpage"):
+            page = regionpage_xml.get("name")
+            regionpage_attributes = etree.Element("regionpage")
+            for k, v in regionpage_xml.attrib.items():
+                regionpage_attributes.set(k, v)
+            entries[("regionpage", page, page)] = etree.tostring(
+                regionpage_attributes
+            ).decode()
+            for region_xml in regionpage_xml.xpath("./region"):
+                entries[("region", page, region_xml.get("id"))] = etree.tostring(
+                    region_xml
+                ).decode()
+            for rule_xml in regionpage_xml.xpath("./rule"):
+                entries[("rule", page, rule_xml.get("values"))] = etree.tostring(
+                    rule_xml
+                ).decode()
+        return entries
+
+    def mark_published(self, touched, touched_pages=()):
+        """Record entries changed by peer ops or a snapshot as
+        published, along with every entry of touched_pages.
+        Unpublished local changes to other entries stay pending"""
+        entries = self.session_entries()
+        touched = set(touched)
+        touched.update(
+            entry
+            for entry in itertools.chain(entries, self.published_entries)
+            if entry[1] in touched_pages
+        )
+        for entry in touched:
+            if entry in entries:
+                self.published_entries[entry] = entries[entry]
+            else:
+                self.published_entries.pop(entry, None)
+
+    @property
+    def session_ops_key(self):
+        return self.session_key + ":ops"
+
+    def session_changes(self):
+        """Current entries and the (op, entry, xml) changes made
+        to them since they were last published or written"""
+        entries = self.session_entries()
+        ops = []
+        for entry, xml in entries.items():
+            previous = self.published_entries.get(entry)
+            if previous is None:
+                ops.append(("add", entry, xml))
+            elif previous != xml:
+                ops.append(("update", entry, xml))
+        for entry in self.published_entries:
+            if entry not in entries:
+                ops.append(("remove", entry, ""))
+        return entries, ops
+
+    def publish_session_ops(self):
+        # send only what changed since the last publish
+        entries, ops = self.session_changes()
+        self.published_entries = entries
+        if not ops:
+            return
+        pipe = redis_conn.pipeline()
+        for op, (kind, page, entry_id), xml in ops:
+            pipe.xadd(
+                self.session_ops_key,
+                {
+                    "op": op,
+                    "kind": kind,
+                    "page": page,
+                    "id": entry_id,
+                    "xml": xml,
+                    "origin": self.origin,
+                },
+            )
+        pipe.xlen(self.session_ops_key)
+        results = pipe.execute()
+        if results[-1] > self.session_compact_threshold:
+            self.compact_session()
+
+    def compact_session(self):
+        """Store the full session as a snapshot of the op stream
+        and trim older ops
+
+        Ops of peers are applied first, they may still be waiting
+        in the event window, so that the snapshot holds every op up
+        to the applied version it is labelled with.
+        """
+        self.sync_session_ops()
+        if self.session_version == "0-0":
+            return
+        session_string = etree.tostring(self.as_xml(), pretty_print=True).decode()
+        pipe = redis_conn.pipeline()
+        pipe.hmset(
+            self.session_key, {"xml": session_string, "stream_id": self.session_version}
+        )
+        # peers further behind than what is kept reload the snapshot
+        pipe.xtrim(
+            self.session_ops_key, maxlen=max(1, self.session_compact_threshold // 4)
+        )
+        pipe.execute()
+
+    def sync_session_ops(self, resync=True):
+        """Apply ops added to the session stream since the last
+        applied version"""
+        if not self.img.script.sync_with_others:
+            return
+        ops = redis_conn.xrange(self.session_ops_key, min=self.session_version)
+        if self.session_version != "0-0":
+            # the range is inclusive, the last applied op should be first,
+            # if it is missing the stream was trimmed past it
+            if not ops or ops[0][0] != self.session_version:
+                if resync:
+                    self.load_session_snapshot()
+                    self.sync_session_ops(resync=False)
+                else:
+                    print("session ops missing after {}".format(self.session_version))
+                return
+            ops = ops[1:]
+        touched = set()
+        touched_pages = set()
+        for op_id, op in ops:
+            # own ops are applied again, every station then ends
+            # with the state of the ops in stream order. Changes
+            # are written before syncing, so no local change is
+            # newer than the own ops
+            try:
+                self.apply_session_op(op)
+                touched.add((op["kind"], op["page"], op["id"]))
+                if op["kind"] == "regionpage":
+                    # adding or removing a page changes its rules too
+                    touched_pages.add(op["page"])
+            except Exception as ex:
+                print(ex)
+            self.session_version = op_id
+        if not touched:
+            return
+        self.mark_published(touched, touched_pages)
+        self.redraw_session()
+
+    def apply_session_op(self, op):
+        page = self.region_pages.get(op["page"])
+        if op["kind"] == "region":
+            if page is not None:
+                apply_region_op(page, op)
+            return
+        if op["op"] == "remove":
+            if op["kind"] == "regionpage" and page is not None:
+                if page is not self.default_region_page:
+                    self.region_pages.remove(page)
+            return
+        xml = etree.fromstring(op["xml"])
+        if op["kind"] == "regionpage":
+            self.apply_regionpage_xml(xml)
+        elif op["kind"] == "rule" and page is not None:
+            self.apply_rule_xml(page, xml)
+
+    def load_session_snapshot(self):
+        xml, stream_id = redis_conn.hmget(self.session_key, "xml", "stream_id")
+        if xml is not None:
+            xml = etree.fromstring(xml)
+            self.update_session(xml)
+            # the snapshot replaces the regions and rules of its pages
+            snapshot = self.session_entries(xml)
+            self.mark_published(snapshot, set(entry[1] for entry in snapshot))
+        self.session_version = stream_id or "0-0"
+
     def set_region_page(self, widget):
-        if widget.text not in [region_page.name for region_page in self.region_pages]:
+        region = self.region_pages.get(widget.text)
+        if region is None:
             region = RegionPage(name=widget.text, rules_widget=RuleWidgets(app=self))
             self.region_pages.append(region)
-            self.default_region_page = region
-        else:
-            for region in self.region_pages:
-                if region.name == widget.text:
-                    self.default_region_page = region
+        self.default_region_page = region
         self.update_regions()
         self.rule_box.load_rules(self.default_region_page.rules_widget)
 
@@ -1112,8 +2113,8 @@ class DzzApp(App):
             )
             change_region_name = TextInput(text=region.name, multiline=False)
             change_region_name.bind(
-                on_text_validate=lambda widget, region=region: setattr(
-                    region, "name", widget.text
+                on_text_validate=lambda widget, region=region, regions=self.default_region_page.regions: regions.rename(
+                    region, widget.text
                 )
             )
             row.add_widget(change_region_name)
@@ -1124,7 +2125,7 @@ class DzzApp(App):
                     self.update_regions(),
                     self.img.draw_regions(),
                     self.img.update_region_scripts(),
-                    self.session_to_db(),
+                    self.session_changed(),
                 ]
             )
             row.add_widget(remove_region)
@@ -1137,15 +2138,31 @@ class DzzApp(App):
         return session
 
     def session_to_db(self):
-        session_string = etree.tostring(self.as_xml(), pretty_print=True).decode()
+        if self.session_sync == "oplog":
+            if self.img.script.sync_with_others:
+                self.publish_session_ops()
+            return
+        xml = self.as_xml()
+        session_string = etree.tostring(xml, pretty_print=True).decode()
         if self.img.script.sync_with_others:
-            redis_conn.hmset(self.session_key, {"xml": session_string})
+            pipe = redis_conn.pipeline()
+            pipe.hincrby(self.session_key, "version", 1)
+            pipe.hmset(self.session_key, {"xml": session_string, "origin": self.origin})
+            self.session_document_version, _ = pipe.execute()
+            # base of the changes replayed on a peer document
+            self.published_entries = self.session_entries(xml)
 
     def use_latest_session(self):
         try:
-            self.update_session(
-                etree.fromstring(redis_conn.hget(self.session_key, "xml"))
-            )
+            if self.session_sync == "oplog":
+                self.load_session_snapshot()
+                self.sync_session_ops()
+            else:
+                xml, version = redis_conn.hmget(self.session_key, "xml", "version")
+                self.session_document_version = int(version or 0)
+                xml = etree.fromstring(xml)
+                self.update_session(xml)
+                self.published_entries = self.session_entries(xml)
         except Exception as ex:
             print(ex)
 
@@ -1153,11 +2170,24 @@ class DzzApp(App):
         root = BoxLayout()
         self.img = ClickableImage()
         self.img.app = self
+        self.img.async_load = not self.kwargs.get("sync_image_load")
         root.add_widget(self.img)
         self.img.db_load(self.kwargs["db_key"], self.kwargs["db_key_field"])
         script_box = ScriptBox(source_widget=self.img, size_hint_y=.5)
         # set app for access to rule_box
         script_box.app = self
+        script_box.batch_size = self.kwargs.get("batch_size") or script_box.batch_size
+        script_box.workers = self.kwargs.get("workers") or script_box.workers
+        script_box.pool = self.kwargs.get("pool") or script_box.pool
+        script_box.crop_engine = (
+            self.kwargs.get("crop_engine") or script_box.crop_engine
+        )
+        if self.kwargs.get("ocr_cache_size"):
+            script_box.ocr_cache = OcrCache(
+                script_box.ocr_cache_key,
+                max_entries=self.kwargs["ocr_cache_size"],
+                settings=self.kwargs.get("ocr_settings") or "",
+            )
         region_page = DropDownInput(
             hint_text="enter a regionpage name",
             height=60,
@@ -1173,6 +2203,16 @@ class DzzApp(App):
         upper_right_container = BoxLayout(orientation="vertical")
 
         self.img.script = script_box
+        sequence_row = BoxLayout(orientation="horizontal", height=30, size_hint_y=None)
+        previous_button = Button(text="previous")
+        previous_button.bind(on_press=lambda widget: self.step_source(-1))
+        next_button = Button(text="next")
+        next_button.bind(on_press=lambda widget: self.step_source(1))
+        self.sequence_position = Label(text="")
+        sequence_row.add_widget(previous_button)
+        sequence_row.add_widget(self.sequence_position)
+        sequence_row.add_widget(next_button)
+        tool_container.add_widget(sequence_row)
         tool_container.add_widget(region_page)
         self.rule_box = RuleBox(app=self)
         upper_right_container.add_widget(self.rule_box)
@@ -1181,21 +2221,41 @@ class DzzApp(App):
         upper_container.add_widget(upper_left_container)
         upper_container.add_widget(upper_right_container)
         tool_container.add_widget(upper_container)
-        self.fields = EditViewViewer(self.img.key_value)
+        self.fields = EditViewViewer(
+            self.img.key_value,
+            virtualize_threshold=self.kwargs.get("virtualize_fields"),
+            write_mode=self.kwargs.get("write_mode") or "atomic",
+        )
         tool_container.add_widget(script_box)
         tool_container.add_widget(self.fields)
         root.add_widget(tool_container)
 
         self.db_event_subscription = redis_conn.pubsub()
-        self.db_event_subscription.psubscribe(
-            **{"__keyspace@0__:*": self.handle_db_events}
+        self.retarget_subscriptions()
+        # cached and prefetched textures of any image key
+        keyevent_prefix = "__keyevent@{}__:".format(self.db_index)
+        self.db_event_subscription.subscribe(
+            **{
+                keyevent_prefix + event: self.handle_image_events
+                for event in IMAGE_EVENTS
+            }
         )
         # add thread to pubsub object to stop() on exit
-        self.db_event_subscription.thread = self.db_event_subscription.run_in_thread(
-            sleep_time=0.001
-        )
+        if self.kwargs.get("listener") == "polling":
+            self.db_event_subscription.thread = (
+                self.db_event_subscription.run_in_thread(sleep_time=0.001)
+            )
+        else:
+            self.db_event_subscription.thread = DbEventListener(
+                self.db_event_subscription
+            )
+            self.db_event_subscription.thread.start()
         # try to get existing/latest session
         self.use_latest_session()
+        self.sequence.locate(self.img.key)
+        self.update_sequence_position()
+        if self.sequence.window:
+            self.sequence.prefetch(self.sequence.neighbours(), self.img.key_field)
         return root
 
 
@@ -1216,20 +2276,119 @@ def load_image(uuid, new_size=None):
     return file
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--db-key", help="db hash key")
-    parser.add_argument("--db-key-field", help="db hash field")
-
-    parser.add_argument("--db-host", help="db host ip, requires use of --db-port")
-    parser.add_argument(
-        "--db-port", type=int, help="db port, requires use of --db-host"
+# KEYS[1] hash to write, ARGV[1] ttl and ARGV[2:] field value pairs.
+# Fields not in ARGV are removed. Commands are chunked to stay
+# below the lua stack limit for unpack.
+WRITE_HASH_SCRIPT = """
+local fields = {}
+for i = 2, #ARGV, 2 do
+    fields[ARGV[i]] = true
+end
+local removed = {}
+for _, field in ipairs(redis.call("HKEYS", KEYS[1])) do
+    if not fields[field] then
+        table.insert(removed, field)
+    end
+end
+for i = 1, #removed, 1000 do
+    redis.call("HDEL", KEYS[1], unpack(removed, i, math.min(i + 999, #removed)))
+end
+for i = 2, #ARGV, 2000 do
+    redis.call("HMSET", KEYS[1], unpack(ARGV, i, math.min(i + 1999, #ARGV)))
+end
+local ttl = tonumber(ARGV[1])
+if ttl and ttl > 0 then
+    redis.call("EXPIRE", KEYS[1], ttl)
+end
+return removed
+"""
+
+
+def write_hash(key, fields, ttl=None):
+    """Replace the contents of a hash and set its ttl atomically
+
+    Runs server side in a single round trip, returns the list of
+    fields that were removed.
+    """
+    args = [ttl or -1]
+    for field, value in fields.items():
+        args.extend([field, value])
+    return redis_conn.register_script(WRITE_HASH_SCRIPT)(keys=[key], args=args)
+
+
+def write_hash_watched(key, fields, base, ttl=None):
+    """Replace the contents of a hash unless it changed since base
+
+    base is the hash contents the edit started from. Returns the
+    set of fields changed by others, nothing is written if it is
+    not empty.
+    """
+    with redis_conn.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            current = pipe.hgetall(key)
+            conflicts = changed_fields(current, base)
+            if conflicts:
+                return conflicts
+            pipe.multi()
+            removed = set(current) - set(fields)
+            if removed:
+                pipe.hdel(key, *removed)
+            if fields:
+                pipe.hmset(key, fields)
+            if ttl and ttl > 0:
+                pipe.expire(key, ttl)
+            pipe.execute()
+        except redis.WatchError:
+            # written by others between read and write
+            return changed_fields(redis_conn.hgetall(key), base) or set([key])
+    return set()
+
+
+def changed_fields(current, base):
+    return set(
+        field
+        for field in set(current) | set(base)
+        if current.get(field) != base.get(field)
     )
-    args = parser.parse_args()
 
-    if bool(args.db_host) != bool(args.db_port):
-        parser.error("--db-host and --db-port values are both required")
 
+def decode_pixels(file):
+    """Decode an image file object to raw pixels
+
+    Returns (size, colorfmt, bytes) suitable for a texture blit.
+    Safe to call off the main thread.
+    """
+    img = PImage.open(file)
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        colorfmt = "rgba"
+    else:
+        img = img.convert("RGB")
+        colorfmt = "rgb"
+    size = img.size
+    pixels = img.tobytes()
+    img.close()
+    return size, colorfmt, pixels
+
+
+def pixels_to_texture(size, colorfmt, pixels):
+    """Create a texture from decoded pixels, main thread only"""
+    texture = Texture.create(size=size, colorfmt=colorfmt)
+    texture.blit_buffer(pixels, colorfmt=colorfmt, bufferfmt="ubyte")
+    # pil rows start at the top, texture rows at the bottom
+    texture.flip_vertical()
+    return texture
+
+
+def run(args):
     app = DzzApp(**vars(args))
     atexit.register(app.save_session)
     app.run()
+
+
+def main():
+    # arguments are parsed before the ui is imported
+    from dzz_ui import cli
+
+    cli.main()
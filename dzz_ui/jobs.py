@@ -0,0 +1,128 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import threading
+import time
+
+import attr
+
+from dzz_ui.runner import format_error
+
+
+@attr.s
+class Job(object):
+    function = attr.ib()
+    id = attr.ib()
+    group = attr.ib(default=None)
+    description = attr.ib(default="")
+    # queued, running, done, failed, superseded or cancelled
+    status = attr.ib(default="queued")
+    error = attr.ib(default=None)
+    started = attr.ib(default=None)
+    finished = attr.ib(default=None)
+    # set to ask a running job to stop between steps
+    cancelled = attr.ib(default=attr.Factory(threading.Event))
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+
+class JobQueue(object):
+    """Run jobs one at a time on a background thread
+
+    A job is called with itself and may check job.cancelled. A
+    job submitted with a group supersedes queued jobs of the same
+    group, jobs that already started run to the end. on_change
+    is called with a job whenever its status changes, from the
+    thread that changed it. The last history jobs are kept.
+    """
+
+    def __init__(self, on_change=None, history=20):
+        self.on_change = on_change
+        self.queue = collections.deque()
+        self.jobs = collections.deque(maxlen=history)
+        self.condition = threading.Condition()
+        self.counter = 0
+        self.thread = None
+        self.stopped = False
+
+    def submit(self, function, group=None, description=""):
+        superseded = []
+        with self.condition:
+            if group is not None:
+                superseded = [job for job in self.queue if job.group == group]
+                for job in superseded:
+                    self.queue.remove(job)
+                    job.status = "superseded"
+            self.counter += 1
+            job = Job(
+                function=function,
+                id=self.counter,
+                group=group,
+                description=description,
+            )
+            self.queue.append(job)
+            self.jobs.append(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        for superseded_job in superseded:
+            self.changed(superseded_job)
+        self.changed(job)
+        return job
+
+    def cancel(self):
+        """Drop queued jobs and ask the running one to stop"""
+        with self.condition:
+            cancelled = list(self.queue)
+            self.queue.clear()
+            for job in cancelled:
+                job.status = "cancelled"
+            for job in self.jobs:
+                if job.status == "running":
+                    job.cancelled.set()
+        for job in cancelled:
+            self.changed(job)
+
+    def stop(self):
+        self.cancel()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                job = self.queue.popleft()
+                job.status = "running"
+                job.started = time.time()
+            self.changed(job)
+            try:
+                job.function(job)
+                job.status = "cancelled" if job.cancelled.is_set() else "done"
+            except Exception as ex:
+                job.error = format_error(ex)
+                job.status = "failed"
+                print(job.error)
+            job.finished = time.time()
+            self.changed(job)
+
+    def changed(self, job):
+        if self.on_change is not None:
+            self.on_change(job)
+
+    def recent(self, count=3):
+        with self.condition:
+            return list(self.jobs)[-count:]
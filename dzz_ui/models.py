@@ -0,0 +1,441 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import uuid
+
+import attr
+
+from dzz_ui.startup import lazy_import
+
+colour = lazy_import("colour")
+etree = lazy_import("lxml.etree")
+
+# rule types in the order they are shown and stored
+RULE_TYPES = ("int", "str", "roman", "Range", "STRING")
+
+CROP_SCRIPT = """$$(<"keli img-crop-to-key [*] $KEY --x1 {} --y1 {} --width {} --height {} --to-key {name}_key --db-port $DB_PORT --db-host $DB_HOST">),"""
+OCR_SCRIPT = """$$(<"keli img-ocr-fan-in [*] {name}_key --to-key {name}_ocr --db-port $DB_PORT --db-host $DB_HOST">),"""
+
+
+class NamedList(list):
+    """List of named items with an index by name
+
+    by_name maps a name to its items in list order and follows
+    append, insert, remove and rename. Items with duplicate
+    names are kept in the list, get() returns the last one.
+    Items are removed by identity, attrs items with equal fields
+    compare equal.
+    """
+
+    def __init__(self, items=()):
+        super(NamedList, self).__init__(items)
+        self.reindex()
+
+    def reindex(self):
+        self.by_name = {}
+        for item in self:
+            self.by_name.setdefault(item.name, []).append(item)
+
+    def append(self, item):
+        super(NamedList, self).append(item)
+        self.by_name.setdefault(item.name, []).append(item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def insert(self, position, item):
+        super(NamedList, self).insert(position, item)
+        self.reindex()
+
+    def remove(self, item):
+        for position, other in enumerate(self):
+            if other is item:
+                del self[position]
+                break
+        else:
+            raise ValueError("item not in list")
+        self.unindex(item)
+
+    def unindex(self, item):
+        same_name = [other for other in self.by_name[item.name] if other is not item]
+        if same_name:
+            self.by_name[item.name] = same_name
+        else:
+            self.by_name.pop(item.name)
+
+    def remove_names(self, names):
+        """Remove every item with a name in names in one pass"""
+        self[:] = [item for item in self if item.name not in names]
+        self.reindex()
+
+    def rename(self, item, name):
+        self.unindex(item)
+        item.name = name
+        # keep items of the new name in list order
+        self.reindex()
+
+    def get(self, name, default=None):
+        same_name = self.by_name.get(name)
+        if same_name:
+            return same_name[-1]
+        return default
+
+
+@attr.s
+class RegionPage(object):
+    name = attr.ib()
+    regions = attr.ib(default=attr.Factory(NamedList), converter=NamedList)
+    color = attr.ib(default=None)
+    rules_widget = attr.ib(default=None)
+
+    def output_name(self, region):
+        # outputs are named after the regionpage, rules use
+        # the regionpage name as their source
+        return self.name
+
+    @property
+    def scripts(self):
+        return self.region_scripts(crop=True)
+
+    def region_scripts(self, crop=True):
+        scripts = "("
+        for region in self.regions:
+            # suffixes _key and _ocr
+            if crop:
+                scripts += (
+                    crop_script(self.output_name(region), region.coordinates_scaled)
+                    + "\n"
+                )
+            scripts += ocr_script(self.output_name(region))
+        scripts += ")"
+        return scripts
+
+    @color.validator
+    def check(self, attribute, value):
+        if value is None:
+            setattr(self, "color", colour.Color(pick_for=self))
+
+    def as_xml(self):
+        regionpage = etree.Element("regionpage")
+        regionpage.set("color", self.color.hex_l)
+        regionpage.set("name", self.name)
+        for region in self.regions:
+            regionpage.append(region.as_xml())
+        for rule in self.rules_widget.as_xml():
+            regionpage.append(rule)
+        return regionpage
+
+
+@attr.s
+class Rule(object):
+    source = attr.ib()
+    symbol = attr.ib()
+    values = attr.ib()
+    destination = attr.ib()
+    result = attr.ib()
+
+
+@attr.s
+class RuleWidget(object):
+    source_widget = attr.ib()
+    symbol_widget = attr.ib()
+    values_widget = attr.ib()
+    destination_widget = attr.ib()
+    result_widget = attr.ib()
+    enabled_widget = attr.ib()
+
+    @property
+    def enabled(self):
+        if self.enabled_widget.pressed:
+            return True
+        else:
+            return False
+
+    @property
+    def rule(self):
+        return Rule(
+            source=self.source_widget.text,
+            symbol=self.symbol_widget.text,
+            values=self.values_widget.text,
+            destination=self.destination_widget.text,
+            result=self.result_widget.text,
+        )
+
+
+@attr.s
+class RuleSet(object):
+    name = attr.ib(default="r")
+    rules = attr.ib(default=attr.Factory(list))
+
+    def script(self, keyling=False, newlines=True):
+        scripts = "ruleset {} {{".format(self.name)
+        if newlines:
+            scripts += "\n"
+        for rule in self.rules:
+            if rule.enabled:
+                # suffix _ocr
+                scripts += "{source}_ocr {symbol} {values} -> {destination} {result}".format(
+                    **attr.asdict(rule.rule)
+                )
+                if newlines:
+                    scripts += "\n"
+        scripts += "}"
+
+        if keyling is True:
+            scripts = """($$(<"keli src-ruling-str [*] --db-port $DB_PORT --db-host $DB_HOST  --ruling-string '{}'">),)""".format(
+                scripts
+            )
+
+        print(scripts)
+        return scripts
+
+
+@attr.s
+class StoredRule(object):
+    """Rule and enabled state without widgets, used headless"""
+
+    rule = attr.ib()
+    enabled = attr.ib(default=False)
+
+
+@attr.s
+class StoredRules(object):
+    """Stands in for RuleWidgets of a regionpage without widgets"""
+
+    ruleset = attr.ib(default=attr.Factory(RuleSet))
+
+    def get(self, values):
+        for stored in self.ruleset.rules:
+            if stored.rule.values == values:
+                return stored
+
+    def as_xml(self):
+        rules = []
+        for stored in self.ruleset.rules:
+            rule_xml = etree.Element("rule")
+            for k, v in attr.asdict(stored.rule).items():
+                rule_xml.set(k, v)
+            rule_xml.set("enabled", str(stored.enabled))
+            rules.append(rule_xml)
+        return rules
+
+
+@attr.s
+class Region(object):
+    name = attr.ib()
+    color = attr.ib(default="")
+    # x and y are upper left coordinates
+    x = attr.ib(default=0)
+    y = attr.ib(default=0)
+    w = attr.ib(default=0)
+    h = attr.ib(default=0)
+    scaling_x = attr.ib(default=1)
+    scaling_y = attr.ib(default=1)
+    # stable across stations and renames, session ops use it
+    id = attr.ib(default=attr.Factory(lambda: str(uuid.uuid4())))
+
+    @property
+    def y2(self):
+        return self.y + self.h
+
+    @property
+    def x2(self):
+        return self.x + self.w
+
+    @property
+    def coordinates_unscaled(self):
+        return [self.x, self.y, self.w, self.h]
+
+    @property
+    def coordinates_scaled(self):
+        return [
+            int(self.x / self.scaling_x),
+            int(self.y / self.scaling_y),
+            int(self.w / self.scaling_x),
+            int(self.h / self.scaling_y),
+        ]
+
+    def as_xml(self):
+        region = etree.Element("region")
+        for k, v in attr.asdict(self).items():
+            region.set(k, str(v))
+        # store properties, not needed for recreating object
+        coordinates_scaled = etree.Element("coordinates")
+        coordinates_scaled.set("scaled", "True")
+        coordinates_unscaled = etree.Element("coordinates")
+        coordinates_unscaled.set("scaled", "False")
+        for coords, coords_element in zip(
+            [self.coordinates_unscaled, self.coordinates_scaled],
+            [coordinates_unscaled, coordinates_scaled],
+        ):
+            for coord, coord_name in zip(coords, ["x", "y", "w", "h"]):
+                coords_element.set(coord_name, str(coord))
+        region.append(coordinates_unscaled)
+        region.append(coordinates_scaled)
+        return region
+
+
+def crop_script(name, coordinates):
+    return CROP_SCRIPT.format(*coordinates, name=name)
+
+
+def ocr_script(name):
+    return OCR_SCRIPT.format(name=name)
+
+
+def region_from_xml(region_xml):
+    # use a copy of region attributes
+    r = dict(region_xml.attrib)
+
+    # try to convert back ints and floats
+    for k, v in r.items():
+        try:
+            r[k] = int(v)
+        except Exception as ex:
+            try:
+                r[k] = float(v)
+            except Exception as ex:
+                pass
+            pass
+
+    if "id" not in r:
+        # stored before regions had ids, every station derives
+        # the same one from the same xml
+        r["id"] = str(
+            uuid.uuid5(uuid.NAMESPACE_URL, etree.tostring(region_xml).decode())
+        )
+    return Region(**r)
+
+
+def find_region(regionpage, region_id):
+    for region in regionpage.regions:
+        if region.id == region_id:
+            return region
+    return None
+
+
+def apply_region_op(regionpage, op):
+    """Apply an add, update or remove session op of a region
+
+    Regions are found by id. An add goes to the end, replacing
+    the region if it is already there, so that stations applying
+    the same ops end with the same order. An update of a region
+    that was removed in the meantime is dropped.
+    """
+    existing = find_region(regionpage, op["id"])
+    if op["op"] == "remove":
+        if existing is not None:
+            regionpage.regions.remove(existing)
+        return
+    region = region_from_xml(etree.fromstring(op["xml"]))
+    if op["op"] == "add":
+        if existing is not None:
+            regionpage.regions.remove(existing)
+        regionpage.regions.append(region)
+    elif existing is not None:
+        if existing.name != region.name:
+            regionpage.regions.rename(existing, region.name)
+        for k, v in attr.asdict(region).items():
+            setattr(existing, k, v)
+
+
+def update_regions_from_xml(regionpage, region_xmls):
+    """Make the regions of regionpage those of region_xmls, in
+    their order. Regions with the same id are updated in place.
+    Returns the names of removed regions"""
+    existing = {region.id: region for region in regionpage.regions}
+    regions = []
+    for region_xml in region_xmls:
+        region = region_from_xml(region_xml)
+        current = existing.pop(region.id, None)
+        if current is not None:
+            for k, v in attr.asdict(region).items():
+                setattr(current, k, v)
+            region = current
+        regions.append(region)
+    regionpage.regions[:] = regions
+    regionpage.regions.reindex()
+    return set(region.name for region in existing.values())
+
+
+def stored_rule_from_xml(rule_xml):
+    rule = dict(rule_xml.attrib)
+    enabled = rule.pop("enabled", "false").lower() == "true"
+    return StoredRule(rule=Rule(**rule), enabled=enabled)
+
+
+def regionpages_from_xml(xml):
+    """Regionpages of a session document without widgets
+
+    Rules are StoredRules, regionpages can be turned back into
+    xml and scripts generated the same way as in the ui.
+    """
+    region_pages = NamedList()
+    for session in xml.xpath("//session"):
+        for regionpage_xml in session.xpath("./regionpage"):
+            name = str(regionpage_xml.get("name"))
+            regionpage = region_pages.get(name)
+            if regionpage is None:
+                regionpage = RegionPage(
+                    name=name,
+                    color=colour.Color(regionpage_xml.get("color")),
+                    rules_widget=StoredRules(),
+                )
+                region_pages.append(regionpage)
+            update_regions_from_xml(regionpage, regionpage_xml.xpath("./region"))
+            for rule_xml in regionpage_xml.xpath("./rule"):
+                apply_stored_rule_xml(regionpage, rule_xml)
+    return region_pages
+
+
+def apply_stored_rule_xml(regionpage, rule_xml):
+    stored = stored_rule_from_xml(rule_xml)
+    existing = regionpage.rules_widget.get(stored.rule.values)
+    if existing is not None:
+        existing.rule = stored.rule
+        existing.enabled = stored.enabled
+    else:
+        regionpage.rules_widget.ruleset.rules.append(stored)
+
+
+def apply_session_op(region_pages, op):
+    """Apply a session stream op to regionpages without widgets"""
+    page = region_pages.get(op["page"])
+    if op["kind"] == "region":
+        if page is not None:
+            apply_region_op(page, op)
+        return
+    if op["op"] == "remove":
+        if op["kind"] == "regionpage" and page is not None:
+            region_pages.remove(page)
+        return
+    xml = etree.fromstring(op["xml"])
+    if op["kind"] == "regionpage" and page is None:
+        region_pages.append(
+            RegionPage(
+                name=xml.get("name"),
+                color=colour.Color(xml.get("color")),
+                rules_widget=StoredRules(),
+            )
+        )
+    elif op["kind"] == "rule" and page is not None:
+        apply_stored_rule_xml(page, xml)
+
+
+def generate_scripts(region_pages):
+    """Region scripts and ruling scripts of regionpages
+
+    Always the keli scripts, the inprocess crop engine runs the
+    same steps without the region scripts but they are still
+    shown and can be run by hand.
+    """
+    scripts = ""
+    rule_scripts = ""
+    for r in region_pages:
+        scripts += r.scripts + "\n"
+        rule_scripts += r.rules_widget.ruleset.script(keyling=True, newlines=False)
+    return scripts, rule_scripts
@@ -0,0 +1,101 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import hashlib
+import time
+
+from dzz_ui.db import redis_conn
+from dzz_ui.models import OCR_SCRIPT
+
+
+class OcrCache(object):
+    """Ocr results by image content, region coordinates and settings
+
+    Kept in the db so results are reused across runs, sessions
+    and users. key is a hash of entry to text, key:lru a sorted
+    set of entry to last use and key:stats counts hits, misses
+    and evictions. Least recently used entries are evicted when
+    there are more than max_entries. Only plain attributes, can
+    be sent to worker processes.
+    """
+
+    def __init__(self, key, max_entries=100000, settings=""):
+        self.key = key
+        self.lru_key = key + ":lru"
+        self.stats_key = key + ":stats"
+        self.max_entries = max_entries
+        # anything that changes ocr output, changing it
+        # makes earlier entries miss
+        self.settings = settings
+
+    def entry(self, fingerprint, coordinates):
+        # the ocr script is part of the settings
+        return hashlib.sha1(
+            "{}:{}:{}:{}".format(
+                fingerprint,
+                ",".join(str(c) for c in coordinates),
+                OCR_SCRIPT,
+                self.settings,
+            ).encode()
+        ).hexdigest()
+
+    def get_many(self, entries):
+        """Return a dict of entry to cached text for entries found"""
+        if not entries:
+            return {}
+        found = {
+            entry: text
+            for entry, text in zip(entries, redis_conn.hmget(self.key, entries))
+            if text is not None
+        }
+        pipe = redis_conn.pipeline(transaction=False)
+        if found:
+            now = time.time()
+            pipe.zadd(self.lru_key, {entry: now for entry in found})
+            pipe.hincrby(self.stats_key, "hits", len(found))
+        if len(entries) > len(found):
+            pipe.hincrby(self.stats_key, "misses", len(entries) - len(found))
+        pipe.execute()
+        return found
+
+    def put_many(self, results):
+        """Store a dict of entry to text"""
+        if not results:
+            return
+        now = time.time()
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hmset(self.key, results)
+        pipe.zadd(self.lru_key, {entry: now for entry in results})
+        pipe.zcard(self.lru_key)
+        size = pipe.execute()[-1]
+        if size > self.max_entries:
+            self.evict(size - self.max_entries)
+
+    def evict(self, count):
+        entries = redis_conn.zrange(self.lru_key, 0, count - 1)
+        if not entries:
+            return
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hdel(self.key, *entries)
+        pipe.zrem(self.lru_key, *entries)
+        pipe.hincrby(self.stats_key, "evictions", len(entries))
+        pipe.execute()
+
+    def clear(self):
+        redis_conn.delete(self.key, self.lru_key, self.stats_key)
+
+    def stats(self):
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hgetall(self.stats_key)
+        pipe.zcard(self.lru_key)
+        counts, entries = pipe.execute()
+        stats = {
+            name: int(counts.get(name, 0)) for name in ("hits", "misses", "evictions")
+        }
+        looked_up = stats["hits"] + stats["misses"]
+        stats["entries"] = entries
+        stats["hit_rate"] = stats["hits"] / looked_up if looked_up else 0
+        return stats
@@ -0,0 +1,105 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import threading
+
+import attr
+
+
+@attr.s
+class Plan(object):
+    """Steps to run on a source, see StepPlanner.plan"""
+
+    key = attr.ib()
+    # (name, scaled coordinates) of outputs to crop and ocr
+    regions = attr.ib(default=attr.Factory(list))
+    # regionpages whose rulesets need to run
+    rule_pages = attr.ib(default=attr.Factory(list))
+    # signature of every step after the plan has run
+    signatures = attr.ib(default=attr.Factory(dict))
+
+    def __bool__(self):
+        return bool(self.regions or self.rule_pages)
+
+
+class StepPlanner(object):
+    """Find the crop, ocr and ruling steps affected by an edit
+
+    Each {name}_key and {name}_ocr output is a region step whose
+    signature is the image and the coordinates of the region
+    that writes it last. A ruleset is a step whose signature is
+    its script and the signatures of the outputs its enabled
+    rules read, so editing a region also reruns the rules that
+    read it. Signatures of what last ran are kept per source for
+    up to max_sources sources. Plans are made on the ui thread
+    and marked done from the thread that ran them.
+    """
+
+    def __init__(self, max_sources=1000):
+        self.max_sources = max_sources
+        self.ran = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def signatures(image_key, region_pages):
+        regions = collections.OrderedDict()
+        for region_page in region_pages:
+            for region in region_page.regions:
+                regions[region_page.output_name(region)] = (
+                    image_key,
+                    tuple(region.coordinates_scaled),
+                )
+        rulesets = collections.OrderedDict()
+        for region_page in region_pages:
+            ruleset = region_page.rules_widget.ruleset
+            reads = sorted(
+                set(
+                    rule.rule.source
+                    for rule in ruleset.rules
+                    if rule.enabled and rule.rule.source
+                )
+            )
+            rulesets[region_page.name] = (
+                ruleset.script(keyling=True, newlines=False),
+                tuple((name, regions.get(name)) for name in reads),
+            )
+        return regions, rulesets
+
+    def plan(self, key, image_key, region_pages):
+        """Return a Plan of the steps whose signature changed
+        since they last ran on source key"""
+        regions, rulesets = self.signatures(image_key, region_pages)
+        with self.lock:
+            previous = self.ran.get(key, {})
+        plan = Plan(key=key)
+        for name, signature in regions.items():
+            if previous.get(("region", name)) != signature:
+                plan.regions.append((name, signature[1]))
+            plan.signatures[("region", name)] = signature
+        for region_page in region_pages:
+            signature = rulesets[region_page.name]
+            if previous.get(("rules", region_page.name)) != signature:
+                plan.rule_pages.append(region_page)
+            plan.signatures[("rules", region_page.name)] = signature
+        return plan
+
+    def done(self, plan):
+        """Record the steps of plan as run"""
+        with self.lock:
+            signatures = dict(self.ran.pop(plan.key, {}))
+            signatures.update(plan.signatures)
+            self.ran[plan.key] = signatures
+            while len(self.ran) > self.max_sources:
+                self.ran.popitem(last=False)
+
+    def forget(self, key=None):
+        """Run every step next time, for one source or all"""
+        with self.lock:
+            if key is None:
+                self.ran.clear()
+            else:
+                self.ran.pop(key, None)
@@ -0,0 +1,366 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+import traceback
+
+import dzz_ui.crop as crop
+import dzz_ui.db as db
+from dzz_ui.db import redis_conn
+from dzz_ui.models import ocr_script
+from dzz_ui.startup import lazy_import
+
+keyling = lazy_import("fold_ui.keyling")
+
+
+class ScriptError(Exception):
+    """A script that does not parse, args[0] is the parse error"""
+
+
+class ScriptCache(object):
+    """Least recently used cache of keyling models by script text
+
+    Scripts that do not parse are cached with their error, which
+    is raised again without parsing. Shared by threads.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def compile(self, script):
+        with self.lock:
+            entry = self.entries.pop(script, None)
+            if entry is not None:
+                # reinsert as most recently used
+                self.entries[script] = entry
+                self.hits += 1
+        if entry is None:
+            try:
+                entry = (keyling.model(script), None)
+            except Exception as ex:
+                entry = (None, ex)
+            with self.lock:
+                self.misses += 1
+                self.entries[script] = entry
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        model, error = entry
+        if error is not None:
+            # a new exception each time, reraising the cached one
+            # would keep adding to its traceback
+            raise ScriptError(error)
+        return model
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+script_cache = ScriptCache()
+compile_script = script_cache.compile
+
+
+class SourceRunner(object):
+    """Run a keyling script over every source of a list on a pool
+
+    Sources are fetched in batches and submitted as workers become
+    free, so only a bounded number are held in memory. Runs on its
+    own thread, progress() can be read at any time and cancel()
+    stops submitting and drops sources that have not started.
+    Errors are kept per source and written to the errors_key hash
+    when the run ends.
+    """
+
+    def __init__(
+        self,
+        script,
+        sources_key,
+        env_vars,
+        workers=None,
+        pool="thread",
+        batch_size=500,
+        errors_key=None,
+        crops=None,
+        key_field=None,
+        ocr_cache=None,
+    ):
+        self.script = script
+        self.sources_key = sources_key
+        # called with (key, position) to get env vars for a source
+        self.env_vars = env_vars
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = pool
+        self.batch_size = batch_size
+        self.errors_key = errors_key
+        # regions cropped and ocred before the script runs,
+        # from the image key stored in key_field of each source
+        self.crops = crops
+        self.key_field = key_field
+        self.ocr_cache = ocr_cache
+        self.errors = collections.OrderedDict()
+        # error of the run itself rather than of a source
+        self.error = None
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+        self.running = False
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def scripts(self):
+        scripts = [self.script] if isinstance(self.script, str) else self.script
+        return [script for script in scripts if script.strip()]
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        self.running = True
+        self.started = time.time()
+        try:
+            # parsed once here, a script that does not parse is
+            # reported once instead of failing every source
+            for script in self.scripts:
+                compile_script(script)
+            self.total = redis_conn.llen(self.sources_key)
+            if self.crops or self.scripts:
+                self.run_sources()
+        except Exception as ex:
+            # errors of the run itself are kept under the list key
+            self.error = format_error(ex)
+            self.errors[self.sources_key] = self.error
+        finally:
+            self.finished = time.time()
+            try:
+                self.write_errors()
+            finally:
+                self.running = False
+
+    def run_sources(self):
+        options = {}
+        if self.pool == "process":
+            executor_class = concurrent.futures.ProcessPoolExecutor
+            # workers connect to the db of this process, not
+            # to one found by discovery
+            options = dict(initializer=db.configure, initargs=db.connections.settings())
+        else:
+            executor_class = concurrent.futures.ThreadPoolExecutor
+        in_flight = set()
+        with executor_class(max_workers=self.workers, **options) as executor:
+            for position, key, source in iter_sources(
+                self.sources_key, self.batch_size
+            ):
+                if self.cancelled.is_set():
+                    break
+                # keep a few sources queued per worker
+                if len(in_flight) >= self.workers * 2:
+                    _, in_flight = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                future = executor.submit(
+                    run_source_script,
+                    self.scripts,
+                    source,
+                    self.env_vars(key, position),
+                    self.crops,
+                    self.key_field,
+                    self.ocr_cache,
+                )
+                future.add_done_callback(
+                    lambda future, key=key: self.source_done(key, future)
+                )
+                in_flight.add(future)
+            if self.cancelled.is_set():
+                for future in in_flight:
+                    future.cancel()
+
+    def source_done(self, key, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        with self.lock:
+            if error is None:
+                self.done += 1
+            else:
+                self.failed += 1
+                self.errors[key] = format_error(error)
+
+    def write_errors(self):
+        for key, error in self.errors.items():
+            print("{} failed: {}".format(key, error))
+        if self.errors_key is None:
+            return
+        pipe = redis_conn.pipeline()
+        pipe.delete(self.errors_key)
+        if self.errors:
+            pipe.hmset(self.errors_key, self.errors)
+        pipe.execute()
+
+    def progress(self):
+        with self.lock:
+            done = self.done
+            failed = self.failed
+        elapsed = 0
+        if self.started is not None:
+            elapsed = (self.finished or time.time()) - self.started
+        processed = done + failed
+        rate = processed / elapsed if elapsed else 0
+        eta = None
+        if rate:
+            eta = max(0, self.total - processed) / rate
+        return {
+            "total": self.total,
+            "done": done,
+            "failed": failed,
+            "rate": rate,
+            "eta": eta,
+            "error": self.error,
+            "cancelled": self.cancelled.is_set(),
+        }
+
+
+def run_source_script(
+    script, source, env_vars, crops=None, key_field=None, ocr_cache=None
+):
+    """Run script on a single source, used by SourceRunner workers
+
+    script may be a list of scripts that are run in order, each
+    one after the first sees what earlier ones wrote. If crops
+    is a crop plan its regions are cropped and ocred first.
+    """
+    key = source["META_DB_KEY"]
+    scripts = [script] if isinstance(script, str) else script
+    source_modified = None
+    refresh = False
+    if crops:
+        run_regions(source, env_vars, crops, key_field, ocr_cache)
+        refresh = True
+    for script in scripts:
+        if not script.strip():
+            continue
+        if refresh:
+            source = fetch_source(key)
+        source_modified = run_keyling(script, source, env_vars)
+        refresh = True
+    return source_modified
+
+
+def fetch_source(key):
+    source = redis_conn.hgetall(key)
+    source.update({"META_DB_KEY": key})
+    return source
+
+
+def run_keyling(script, source, env_vars):
+    key = source["META_DB_KEY"]
+    model = compile_script(script)
+    return keyling.parse_lines(
+        model,
+        source,
+        key,
+        allow_shell_calls=True,
+        env_vars=env_vars,
+        source_updates=lambda: redis_conn.hgetall(key),
+    )
+
+
+def run_regions(source, env_vars, crops, key_field, ocr_cache=None):
+    """Crop and ocr the regions of a crop plan on a single source
+
+    Regions found in ocr_cache get their _ocr field from it, the
+    others are ocred with keli and their results cached. Returns
+    the names of regions that were ocred.
+    """
+    key = source["META_DB_KEY"]
+    fingerprint, fields = crop.crop_regions(key, source.get(key_field), crops)
+    # fields end up with the last region of a name
+    regions = collections.OrderedDict()
+    for name, coordinates in crops:
+        if "{}_key".format(name) in fields:
+            regions[name] = coordinates
+    entries = {}
+    cached = {}
+    if ocr_cache is not None:
+        entries = {
+            name: ocr_cache.entry(fingerprint, coordinates)
+            for name, coordinates in regions.items()
+        }
+        cached = ocr_cache.get_many(list(set(entries.values())))
+    hits = {
+        "{}_ocr".format(name): cached[entries[name]]
+        for name in regions
+        if entries.get(name) in cached
+    }
+    misses = [name for name in regions if "{}_ocr".format(name) not in hits]
+    pipe = redis_conn.pipeline(transaction=False)
+    if hits:
+        pipe.hmset(key, hits)
+    if misses:
+        # a result left from other coordinates must not be cached
+        pipe.hdel(key, *["{}_ocr".format(name) for name in misses])
+    pipe.execute()
+    if not misses:
+        return misses
+
+    source.update(fields)
+    run_keyling(
+        "(" + "".join(ocr_script(name) for name in misses) + ")", source, env_vars
+    )
+    if ocr_cache is not None:
+        texts = redis_conn.hmget(key, ["{}_ocr".format(name) for name in misses])
+        ocr_cache.put_many(
+            {
+                entries[name]: text
+                for name, text in zip(misses, texts)
+                if text is not None
+            }
+        )
+    return misses
+
+
+def format_error(error):
+    return "".join(traceback.format_exception(type(error), error, error.__traceback__))
+
+
+def iter_sources(sources_key, batch_size=500):
+    """Yield (position, key, source) for every key in a list
+
+    Source hashes are fetched in pipelined batches of batch_size
+    and META_DB_KEY is added to each one.
+    """
+    keys = redis_conn.lrange(sources_key, 0, -1)
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start : start + batch_size]
+        pipe = redis_conn.pipeline(transaction=False)
+        for key in batch:
+            pipe.hgetall(key)
+        for offset, (key, source) in enumerate(zip(batch, pipe.execute())):
+            source.update({"META_DB_KEY": key})
+            yield start + offset, key, source
@@ -0,0 +1,77 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import contextlib
+import importlib
+import threading
+import time
+
+
+class StartupProfile(object):
+    """Timings of startup steps relative to the start of the process
+
+    Records nothing unless enabled. Steps recorded with once=True
+    are only kept the first time, for example the first decode.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.start = time.perf_counter()
+        self.steps = []
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def record(self, name, duration=None, once=False):
+        if not self.enabled:
+            return
+        with self.lock:
+            if once and name in self.seen:
+                return
+            self.seen.add(name)
+            self.steps.append((name, time.perf_counter() - self.start, duration))
+
+    @contextlib.contextmanager
+    def timed(self, name, once=False):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, once=once)
+
+    def report(self):
+        if not self.enabled:
+            return
+        print("startup profile:")
+        with self.lock:
+            steps = list(self.steps)
+        for name, at, duration in steps:
+            if duration is None:
+                print("  {:<40} at {:.3f}s".format(name, at))
+            else:
+                print("  {:<40} at {:.3f}s took {:.3f}s".format(name, at, duration))
+
+
+class LazyModule(object):
+    """Module that is imported on first attribute access"""
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def __getattr__(self, attribute):
+        module = self.__dict__["_module"]
+        if module is None:
+            with profile.timed("import {}".format(self._name)):
+                module = importlib.import_module(self._name)
+            self.__dict__["_module"] = module
+        return getattr(module, attribute)
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+profile = StartupProfile()
@@ -17,6 +17,8 @@ setup(
         "lings",
         "keli",
         "Pillow",
+        # NEVER_DECODE in redis.client
+        "redis>=4.1.0",
         "fold_ui",
         "pre-commit",
     ],
@@ -28,8 +30,8 @@ setup(
     ],
     entry_points={
         "console_scripts": [
-            "ma-ui-dzz = dzz_ui.dzz_ui:main",
-            "dzz-ui = dzz_ui.dzz_ui:main",
+            "ma-ui-dzz = dzz_ui.cli:main",
+            "dzz-ui = dzz_ui.cli:main",
         ]
     },
 )
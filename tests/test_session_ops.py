@@ -0,0 +1,139 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+"""Stations applying the same session stream end with the same regions"""
+
+import pytest
+
+pytest.importorskip("lxml")
+pytest.importorskip("colour")
+
+from lxml import etree  # noqa: E402
+
+from dzz_ui.models import (  # noqa: E402
+    NamedList,
+    Region,
+    RegionPage,
+    StoredRules,
+    apply_session_op,
+    region_from_xml,
+    update_regions_from_xml,
+)
+
+
+def station():
+    return NamedList([RegionPage(name="p", color="red", rules_widget=StoredRules())])
+
+
+def region_op(op, region):
+    return {
+        "op": op,
+        "kind": "region",
+        "page": "p",
+        "id": region.id,
+        "xml": etree.tostring(region.as_xml()).decode() if op != "remove" else "",
+    }
+
+
+def regions(region_pages):
+    return [
+        (region.id, region.name, region.x) for region in region_pages.get("p").regions
+    ]
+
+
+def test_same_name_added_by_two_stations():
+    a, b = station(), station()
+    # both add a region in the same cell before seeing the other
+    region_a = Region(name="top left", x=1)
+    region_b = Region(name="top left", x=2)
+    a.get("p").regions.append(region_a)
+    b.get("p").regions.append(region_b)
+    stream = [region_op("add", region_a), region_op("add", region_b)]
+    for op in stream:
+        apply_session_op(a, op)
+        apply_session_op(b, op)
+    assert regions(a) == regions(b)
+    assert [x for _, _, x in regions(a)] == [1, 2]
+
+
+def test_same_region_updated_by_two_stations():
+    region = Region(name="top left", x=1)
+    a, b = station(), station()
+    for region_pages in (a, b):
+        apply_session_op(region_pages, region_op("add", region))
+    a.get("p").regions[0].x = 10
+    b.get("p").regions[0].x = 20
+    stream = [
+        region_op("update", a.get("p").regions[0]),
+        region_op("update", b.get("p").regions[0]),
+    ]
+    for op in stream:
+        apply_session_op(a, op)
+        apply_session_op(b, op)
+    assert regions(a) == regions(b)
+    assert [x for _, _, x in regions(a)] == [20]
+
+
+def test_update_after_remove_of_another_region():
+    first = Region(name="top left", x=1)
+    second = Region(name="top left", x=2)
+    a, b = station(), station()
+    for region_pages in (a, b):
+        apply_session_op(region_pages, region_op("add", first))
+        apply_session_op(region_pages, region_op("add", second))
+    a.get("p").regions.remove(a.get("p").regions[0])
+    b.get("p").regions[1].x = 20
+    stream = [region_op("remove", first), region_op("update", b.get("p").regions[1])]
+    for op in stream:
+        apply_session_op(a, op)
+        apply_session_op(b, op)
+    assert regions(a) == regions(b)
+    assert regions(a) == [(second.id, "top left", 20)]
+
+
+def test_update_of_removed_region_is_dropped():
+    region = Region(name="top left", x=1)
+    a, b = station(), station()
+    for region_pages in (a, b):
+        apply_session_op(region_pages, region_op("add", region))
+    a.get("p").regions.remove(a.get("p").regions[0])
+    b.get("p").regions[0].x = 20
+    stream = [region_op("remove", region), region_op("update", b.get("p").regions[0])]
+    for op in stream:
+        apply_session_op(a, op)
+        apply_session_op(b, op)
+    assert regions(a) == regions(b) == []
+
+
+def test_rename_keeps_index():
+    region = Region(name="top left", x=1)
+    a = station()
+    apply_session_op(a, region_op("add", region))
+    renamed = Region(name="top right", x=1, id=region.id)
+    apply_session_op(a, region_op("update", renamed))
+    assert a.get("p").regions.get("top left") is None
+    assert a.get("p").regions.get("top right").id == region.id
+
+
+def test_region_without_id_gets_the_same_id_everywhere():
+    xml = etree.fromstring('<region name="top left" x="1"/>')
+    assert region_from_xml(xml).id == region_from_xml(xml).id
+
+
+def test_regions_from_xml_replace_duplicates():
+    a, b = station(), station()
+    for x in (1, 2):
+        a.get("p").regions.append(Region(name="top left", x=x))
+    for x in (10, 20):
+        b.get("p").regions.append(Region(name="top left", x=x))
+    kept = a.get("p").regions[0]
+    kept.x = 5
+    region_xmls = [region.as_xml() for region in b.get("p").regions]
+    region_xmls.insert(0, kept.as_xml())
+    removed = update_regions_from_xml(a.get("p"), region_xmls)
+    assert removed == set(["top left"])
+    assert regions(a) == [(kept.id, "top left", 5)] + regions(b)
+    assert a.get("p").regions[0] is kept